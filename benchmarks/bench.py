@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# SPDX-License-Identifier: Unlicense
+"""
+Benchmarks of the bundled models. Example:
+
+./benchmarks/bench.py run --output baseline.json
+./benchmarks/bench.py run --cases 'world3/s2/*' --engine interpret
+./benchmarks/bench.py compare baseline.json            # run again
+./benchmarks/bench.py compare baseline.json new.json   # no run
+
+The model construction, set_rank() and run() are timed (best of
+--repeat) for each case. The run is reported as steps/s and node
+evaluations/s (steps times the number of evaluated nodes). The run
+time includes compiling for the compile engine. The peak memory
+(Python allocations, tracemalloc) of construction and run is
+measured in a separate, untimed, pass.
+
+"compare" flags a case as a regression when a time or the peak
+memory has grown more than --threshold (a fraction) compared to the
+baseline, and then exits with 1. Times shorter than --min-time are
+not compared.
+"""
+import sys
+import os
+import argparse
+import fnmatch
+import json
+import platform
+import time
+import tracemalloc
+import numpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import system_dynamic as sd
+import world3_model
+import grass_sheep
+import predator_prey
+import pond
+import le
+
+dbg = lambda *arg: 0
+
+# ----------------------------------------------------------------------
+# Cases. A case is (name, build, run), where build() returns a System,
+# and run(s) runs it and returns the number of steps and node
+# evaluations
+
+# run_model Runs s to the end time
+def run_model(s):
+    s.run()
+    return s.steps, s.steps * (len(s.nodesrank) - s.pruned)
+
+def world3_case(scenario, version, ts):
+    def build():
+        s = sd.System(init_time=1900, end_time=2100, time_step=ts)
+        world3_model.load(s, scenario=scenario, version=version)
+        return s
+    return (f"world3/s{scenario}/v{version}/ts{ts}", build, run_model)
+
+def grass_sheep_case(dd):
+    def build():
+        s = sd.System(time_step=0.01, end_time=25)
+        grass_sheep.load_model(s, delay=dd)
+        return s
+    return (f"grass_sheep/dd{dd}", build, run_model)
+
+def predator_prey_case():
+    def build():
+        s = sd.System(time_step=0.001, end_time=100, time_unit="time")
+        predator_prey.load_model(s, [1.1, 0.4, 0.4, 0.1], [10, 10])
+        return s
+    return ("predator_prey/ts0.001", build, run_model)
+
+# The pond with the delay constants of pond.py, run one by one
+def pond_case():
+    def build():
+        s = sd.System(time_step=0.1, time_unit='Day')
+        pond.load_model(s)
+        return s
+    def run(s):
+        steps = evals = 0
+        for c in [0.5, 1, 2, 4, 6, 8]:
+            s.nodes['delay_constant'].val = c
+            s.reset()
+            st, ev = run_model(s)
+            steps, evals = steps + st, evals + ev
+        return steps, evals
+    return ("pond/sweep", build, run)
+
+# The life expectancy sweep of le.le_test(), as a batch run
+def le_case():
+    x = list(range(28, 95, 2))
+    def build():
+        s = sd.System(init_time=0, end_time=300, time_step=1)
+        le.load_pop(s)
+        le.modify_M(s)
+        return s
+    def run(s):
+        s.set_rank()
+        s.run_batch({"LE": x}, outputs=["pop"])
+        steps = int((s.end_time - s.nodes['time'].hist[0]) / s.nodes['TS'].val)
+        return steps * len(x), steps * len(x) * len(s.prune(["pop"]))
+    return ("le/sweep", build, run)
+
+def cases():
+    result = []
+    for version in (1972, 2003):
+        for scenario in range(1, len(world3_model.scenarios) + 1):
+            for ts in (1.0, 0.5, 0.1):
+                result.append(world3_case(scenario, version, ts))
+    for dd in (0, 0.5, 0.7):
+        result.append(grass_sheep_case(dd))
+    result.append(predator_prey_case())
+    result.append(pond_case())
+    result.append(le_case())
+    return result
+
+# ----------------------------------------------------------------------
+# Measurement
+
+# measure Returns the measurements of a case
+def measure(case, engine, method, repeat, memory=True):
+    name, build, run = case
+    best = {'construct': float('inf'), 'set_rank': float('inf'),
+            'run': float('inf')}
+    for i in range(repeat):
+        t = time.perf_counter()
+        s = build()
+        t1 = time.perf_counter()
+        s.set_rank()
+        t2 = time.perf_counter()
+        s.engine, s.method = engine, method
+        steps, evals = run(s)
+        t3 = time.perf_counter()
+        for k, v in zip(best, (t1 - t, t2 - t1, t3 - t2)):
+            best[k] = min(best[k], v)
+    r = dict(best)
+    r['steps'] = steps
+    r['evals'] = evals
+    r['steps_per_s'] = steps / best['run']
+    r['evals_per_s'] = evals / best['run']
+    if memory:
+        tracemalloc.start()
+        s = build()
+        s.engine, s.method = engine, method
+        run(s)
+        r['peak_mib'] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+        tracemalloc.stop()
+    return r
+
+def select(names, patterns):
+    if not patterns:
+        return names
+    return [n for n in names
+            if any(fnmatch.fnmatch(n, p) for p in patterns.split(','))]
+
+# bench Runs the selected cases. Returns a results dict (as the json)
+def bench(patterns, engine, method, repeat, memory=True):
+    all_cases = {c[0]: c for c in cases()}
+    result = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.machine(),
+            'engine': engine, 'method': method, 'repeat': repeat,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S")},
+        'cases': {}}
+    for name in select(list(all_cases), patterns):
+        r = measure(all_cases[name], engine, method, repeat, memory)
+        result['cases'][name] = r
+        print(f"{name:<28}{r['construct']*1e3:>9.1f}{r['set_rank']*1e3:>9.1f}"
+              f"{r['run']*1e3:>10.1f}{r['steps_per_s']:>12.0f}"
+              f"{r['evals_per_s']:>12.0f}{r.get('peak_mib', 0):>9.1f}")
+    return result
+
+header = (f"{'case':<28}{'build ms':>9}{'rank ms':>9}{'run ms':>10}"
+          f"{'steps/s':>12}{'evals/s':>12}{'peak MiB':>9}")
+
+# compare Prints the changes from base to new. Returns the number of
+# regressions. Times shorter than min_time (s) are too noisy to be
+# regressions
+def compare(base, new, threshold, min_time=0.005):
+    regressions = 0
+    print(f"{'case':<28}{'metric':<12}{'base':>12}{'new':>12}{'change':>9}")
+    for name, b in base['cases'].items():
+        n = new['cases'].get(name)
+        if n is None:
+            continue
+        for metric in ('construct', 'set_rank', 'run', 'peak_mib'):
+            if metric not in b or metric not in n or b[metric] <= 0:
+                continue
+            change = n[metric] / b[metric] - 1
+            flag = ""
+            if metric != 'peak_mib' and max(b[metric], n[metric]) < min_time:
+                pass
+            elif change > threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            elif change < -threshold:
+                flag = " improved"
+            if flag or conf.v:
+                print(f"{name:<28}{metric:<12}{b[metric]:>12.4g}"
+                      f"{n[metric]:>12.4g}{change*100:>8.1f}%{flag}")
+    print(f"{regressions} regressions (threshold {threshold*100:.0f}%)")
+    return regressions
+
+# ----------------------------------------------------------------------
+# Commands
+
+def cmd_run(args):
+    """Run the benchmarks"""
+    parser = argparse.ArgumentParser(prog="run", description=cmd_run.__doc__)
+    add_run_args(parser)
+    parser.add_argument('--output', help="Write the results to this file")
+    args = parser.parse_args(args[1:])
+    print(header)
+    result = bench(
+        args.cases, args.engine, args.method, args.repeat, not args.no_memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent='\t')
+    return 0
+
+def cmd_compare(args):
+    """Compare with a baseline.
+
+    Without a "new" file the cases of the baseline are run now, with
+    the same engine and method.
+    """
+    parser = argparse.ArgumentParser(
+        prog="compare", description=cmd_compare.__doc__)
+    parser.add_argument('baseline', help="Baseline json file")
+    parser.add_argument('new', nargs='?', help="Results json file")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="Allowed growth as a fraction (default 0.1)")
+    parser.add_argument(
+        '--min-time', type=float, default=0.005,
+        help="Shorter times (s) are not compared (default 0.005)")
+    parser.add_argument(
+        '--repeat', type=int, default=3, help="Runs per case, best is used")
+    parser.add_argument('--output', help="Write the new results to this file")
+    args = parser.parse_args(args[1:])
+    with open(args.baseline) as f:
+        base = json.load(f)
+    if args.new:
+        with open(args.new) as f:
+            new = json.load(f)
+    else:
+        print(header)
+        new = bench(
+            ",".join(base['cases']), base['meta']['engine'],
+            base['meta']['method'], args.repeat,
+            any('peak_mib' in c for c in base['cases'].values()))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(new, f, indent='\t')
+    return 1 if compare(base, new, args.threshold, args.min_time) else 0
+
+def cmd_list(args):
+    """List the cases"""
+    for c in cases():
+        print(c[0])
+    return 0
+
+def add_run_args(parser):
+    parser.add_argument(
+        '--cases', help="Comma separated patterns, e.g. 'world3/s2/*'")
+    parser.add_argument(
+        '--engine', default="compile", choices=["interpret", "compile"],
+        help="Evaluation engine")
+    parser.add_argument(
+        '--method', default="euler", choices=["euler", "rk4", "rk45"],
+        help="Integration method")
+    parser.add_argument(
+        '--repeat', type=int, default=3, help="Runs per case, best is used")
+    parser.add_argument(
+        '--no-memory', action='store_true', help="Don't measure peak memory")
+
+# ----------------------------------------------------------------------
+# Parse args
+
+def parse_args():
+    cmdfn = [n for n in globals() if n.startswith('cmd_')]
+    cmds = [x.removeprefix('cmd_') for x in cmdfn]
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-v', action='count', default=0, help="verbose")
+    parser.add_argument('cmd', choices=cmds, nargs=argparse.REMAINDER)
+    global conf
+    conf = parser.parse_args()
+
+    global dbg
+    if conf.v:
+        dbg = getattr(__builtins__, 'print')
+    dbg("Program starting", conf, cmds)
+
+    if not conf.cmd:
+        parser.print_help()
+        sys.exit(0)
+    if conf.cmd[0] not in cmds:
+        print("Invalid command")
+        sys.exit(1)
+
+    cmd_function = globals()["cmd_" + conf.cmd[0]]
+    sys.exit(cmd_function(conf.cmd))
+
+
+if __name__ == '__main__':
+    parse_args()
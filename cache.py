@@ -0,0 +1,182 @@
+# SPDX-License-Identifier: Unlicense
+"""
+An on-disk cache of runs.
+
+A run is identified by a fingerprint (sha256) of everything that
+affects the result:
+
+ - the structure; nodes, their types and predecessors, and the code
+   of the equations (including default arguments and closures)
+ - the values of constants and tables, and the initial values and
+   limits of stocks
+ - time settings (init time, time step, end time, save interval),
+   the integration method. Not the engine, since all engines give the
+   same result (see README.md, "Evaluation engines")
+ - the engine version (the source of system_dynamic.py)
+
+run(s) loads the histories and the final state from the cache if the
+fingerprint is there, else it runs the model and stores the result.
+The cache is in "directory" (env SD_CACHE), and the least recently
+used entries are removed when it is larger than "max_size" bytes. The
+entries are stored with results.write(). Example:
+
+  cache.run(s)                  # as s.run()
+  cache.run(s, bypass=True)     # always run, and don't store
+"""
+
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import numpy as np
+import system_dynamic as sd
+import results
+
+directory = os.environ.get(
+    "SD_CACHE", os.path.expanduser("~/.cache/system-dynamics"))
+max_size = 1 << 30
+
+# The engine version
+with open(sd.__file__, 'rb') as f:
+    version = hashlib.sha256(f.read()).hexdigest()
+
+# function_key Returns bytes that identify a function and its
+# captured values
+def function_key(f, depth=0):
+    if f is None:
+        return b'None'
+    if hasattr(f, 'func') and hasattr(f, 'args'):
+        # functools.partial
+        return function_key(f.func, depth) + value_key(
+            (f.args, f.keywords), depth)
+    f = getattr(f, '__func__', f)    # bound methods
+    code = getattr(f, '__code__', None)
+    if code is None:
+        return repr(f).encode()
+    key = marshal.dumps(code) + value_key(f.__defaults__, depth)
+    for cell in f.__closure__ or ():
+        try:
+            key += value_key(cell.cell_contents, depth)
+        except ValueError:
+            key += b'empty'
+    return key
+
+# value_key Returns bytes that identify a value. Nodes, systems and
+# other objects are identified by their name or type only
+def value_key(v, depth=0):
+    if callable(v) and depth < 3:
+        return function_key(v, depth + 1)
+    if type(v) in (list, tuple, sd.Table):
+        return b'(' + b','.join([value_key(x, depth) for x in v]) + b')'
+    if type(v) == dict:
+        return value_key(sorted(v.items(), key=repr), depth)
+    if isinstance(v, sd.Node):
+        return f"<{v.name}>".encode()
+    if v is None or type(v) in (int, float, bool, str, complex):
+        return repr(v).encode()
+    return f"<{type(v).__name__}>".encode()
+
+# fingerprint Returns the key of a run of s to end_time
+def fingerprint(s, end_time=None):
+    h = hashlib.sha256(version.encode())
+    h.update(value_key((
+        s.nodes['time'].hist[0], s.nodes['TS'].val,
+        end_time if end_time else s.end_time, s.save_interval,
+        s.method, s.rtol, s.atol)))
+    for name, n in s.nodes.items():
+        pred = list(n.pred) if type(n.pred) == list else sorted(
+            n.pred, key=lambda p: p.name)
+        h.update(value_key((
+            name, type(n).__name__, [p.name for p in pred], n.save,
+            n.save_interval)))
+        h.update(function_key(n.cons))
+        if type(n) == sd.NodeConstant:
+            h.update(value_key((n.type, n.val)))
+        elif type(n) == sd.NodeStock:
+            h.update(value_key((n.hist[0], n.min, n.max)))
+    return h.hexdigest()
+
+# store Stores the histories and the state of s (after run()) as key
+def store(key, s):
+    nodes = [n for n in s.nodes.values() if hasattr(n, 'hist')]
+    state = {
+        'steps': s.steps,
+        'lengths': {n.name: len(n.hist) for n in nodes},
+        'vals': {n.name: n.val for n in nodes},
+        'delays': {
+            n.name: [n.I1, n.I2, n.I3, n.flow, n.cst]
+            for n in nodes if type(n) == sd.NodeDelay3}}
+    # Written to a temporary directory first, so an entry is complete
+    tmp = os.path.join(directory, f"{key}.{os.getpid()}.tmp")
+    results.write(tmp, s, [n.name for n in nodes])
+    with open(os.path.join(tmp, "state.json"), 'w') as f:
+        json.dump(state, f)
+    try:
+        os.rename(tmp, os.path.join(directory, key))
+    except OSError:
+        shutil.rmtree(tmp)      # stored by someone else
+    evict()
+
+# load Loads the histories and state stored as key into s. Returns
+# False if the key is not in the cache
+def load(key, s):
+    path = os.path.join(directory, key)
+    state_file = os.path.join(path, "state.json")
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+        r = results.read(path)
+    except (OSError, ValueError):
+        return False
+    for name, length in state['lengths'].items():
+        n = s.nodes[name]
+        n.hist = sd.History(np.asarray(r.nodes[name].hist[:length]))
+        n.val = state['vals'][name]
+    for name, d in state['delays'].items():
+        n = s.nodes[name]
+        n.I1, n.I2, n.I3, n.flow, n.cst = d
+    s.steps = state['steps']
+    os.utime(state_file)    # recently used
+    return True
+
+# evict Removes the least recently used entries until the cache is
+# not larger than max_size
+def evict():
+    entries = []
+    total = 0
+    for key in os.listdir(directory):
+        path = os.path.join(directory, key)
+        if key.endswith(".tmp") or not os.path.isdir(path):
+            continue
+        size = sum([e.stat().st_size for e in os.scandir(path)])
+        try:
+            used = os.stat(os.path.join(path, "state.json")).st_mtime
+        except OSError:
+            used = 0
+        entries.append((used, size, path))
+        total += size
+    for used, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+# run Runs s as s.run(end_time), with the result from the cache if
+# it's there. A model that has already run (partly) is just run.
+# Returns True on a cache hit
+def run(s, end_time=None, bypass=False):
+    if bypass or s.steps > 0:
+        s.run(end_time)
+        return False
+    key = fingerprint(s, end_time)
+    if load(key, s):
+        return True
+    s.run(end_time)
+    os.makedirs(directory, exist_ok=True)
+    store(key, s)
+    return False
+
+# clear Removes all entries
+def clear():
+    shutil.rmtree(directory, ignore_errors=True)
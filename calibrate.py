@@ -0,0 +1,198 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Calibration of constants against empirical data.
+
+A set of constants (or initial values of stocks) is fitted so the
+mean NRMSE between model nodes and empirical data is minimised, for
+instance pop against wpop (see empirical_data.py). The optimiser is
+differential evolution (rand/1/bin), which is derivative-free and
+evaluates a whole population of candidates at the time, in a pool of
+processes:
+
+ - Each worker builds the model once with a picklable factory, as
+   for sd.sweep().
+ - A candidate only has to beat its parent in the population. It is
+   run in parts (run(until=...)), and aborted as soon as the error so
+   far can no longer beat that.
+ - Results are memoised, so a parameter vector is not run twice,
+   unless it was aborted and is now compared with a looser bound.
+
+Example:
+
+  r = calibrate.run(
+      factory, {'DCFSN': (3.4, 4.2), 'LEN': (25, 31)},
+      [('wpop', 'pop'), ('wle', 'le')], interval=(1950, 2025))
+  r['params'], r['nrmse']
+"""
+
+import math
+import multiprocessing
+import os
+import numpy as np
+
+#############################################################################
+# Targets are the empirical data the model nodes are compared with,
+# taken from a run with the empirical nodes (the empirical data don't
+# depend on the constants). A target is (model node, time indexes,
+# empirical values). The NRMSE is sqrt(mean((model - empirical)^2)) /
+# mean(empirical) over the indexes where empirical data exists.
+#
+# The sum of squares only grows as the run goes on, so the error of a
+# partial run is a lower bound of the final error.
+#############################################################################
+
+def targets(s, pairs, interval=None):
+    t = np.array(s.nodes['time'].hist, dtype=float)
+    result = []
+    for empiric, model in pairs:
+        e = np.array(s.nodes[empiric].hist, dtype=float)
+        mask = ~np.isnan(e)
+        if interval:
+            mask &= (t >= interval[0]) & (t <= interval[1])
+        index = np.nonzero(mask)[0]
+        result.append((model, index, e[index]))
+    return result
+
+# nrmse Returns the mean NRMSE of the targets, or its lower bound if
+# the run is not complete
+def nrmse(s, targets):
+    errors = []
+    for model, index, actual in targets:
+        h = np.array(s.nodes[model].hist, dtype=float)
+        done = index < len(h)
+        predicted = h[index[done]]
+        sse = ((predicted - actual[done]) ** 2).sum()
+        errors.append(math.sqrt(sse / len(index)) / actual.mean())
+    e = sum(errors) / len(errors)
+    return math.inf if e != e else e
+
+# The model of a calibration worker
+worker = None
+
+def worker_init(factory, targets, checkpoints):
+    global worker
+    s = factory()
+    s.set_rank()
+    worker = (s, s.snapshot(), targets, checkpoints)
+
+# evaluate Runs one candidate (params, bound). Returns the error, or
+# inf if the run was aborted since it couldn't get below bound
+def evaluate(task):
+    params, bound = task
+    s, snapshot, targets, checkpoints = worker
+    s.restore(snapshot)
+    s.set_params(params)
+    # Only the model nodes of the targets are needed
+    outputs = [model for model, index, actual in targets]
+    for until in checkpoints:
+        s.run(until=until, outputs=outputs)
+        if nrmse(s, targets) >= bound:
+            return math.inf
+    s.run(outputs=outputs)
+    return nrmse(s, targets)
+
+#############################################################################
+# run Fits the constants in "ranges" {name: (low, high)} so the mean
+# NRMSE of the (empirical, model) pairs is minimised. A tuple of names
+# is set to the same value (e.g. ('NRI', 'nr')). Candidates are run in
+# "workers" processes (workers=1 runs in this process). "checkpoints"
+# are the times where partial runs are checked, default every 10th of
+# the run. Returns a dict with the best params, its nrmse, and the
+# number of runs and aborted runs
+#############################################################################
+
+def run(
+        factory, ranges, pairs, interval=None, population=None,
+        generations=20, F=0.7, CR=0.9, workers=None, seed=None,
+        checkpoints=None, verbose=False):
+    s = factory()
+    s.run()
+    tg = targets(s, pairs, interval)
+    if checkpoints is None:
+        t = s.nodes['time'].hist
+        checkpoints = [t[0] + (t[-1] - t[0]) * i / 10 for i in range(1, 10)]
+    names = list(ranges)
+    low = np.array([ranges[n][0] for n in names], dtype=float)
+    high = np.array([ranges[n][1] for n in names], dtype=float)
+    k = len(names)
+    rng = np.random.default_rng(seed)
+    NP = population if population else max(8, 4 * k)
+
+    def params(x):
+        p = {}
+        for j, n in enumerate(names):
+            for name in n if type(n) == tuple else (n,):
+                p[name] = float(low[j] + x[j] * (high[j] - low[j]))
+        return p
+
+    # memo {key: (error, bound)}. An aborted run (inf) only says that
+    # the error is not below its bound, so it is run again for a
+    # looser bound
+    memo = {}
+    stats = {'runs': 0, 'aborted': 0}
+    def known(key, b):
+        if key not in memo:
+            return False
+        v, bound = memo[key]
+        return v != math.inf or b <= bound
+    def evaluate_all(xs, bounds, pool):
+        keys = [tuple(params(x).values()) for x in xs]
+        todo = {}
+        for key, x, b in zip(keys, xs, bounds):
+            if known(key, b):
+                continue
+            # The same vector in many trials is run with the loosest bound
+            if key not in todo or b > todo[key][1]:
+                todo[key] = (params(x), b)
+        tasks = list(todo.values())
+        if pool:
+            values = pool.map(evaluate, tasks)
+        else:
+            values = [evaluate(task) for task in tasks]
+        for (key, (p, b)), v in zip(todo.items(), values):
+            memo[key] = (v, b)
+            stats['runs'] += 1
+            if v == math.inf:
+                stats['aborted'] += 1
+        return np.array([memo[key][0] for key in keys])
+
+    # The model's own values are one member of the first population
+    x0 = []
+    for j, n in enumerate(names):
+        v = s.nodes[n[0] if type(n) == tuple else n].val
+        x0.append((v - low[j]) / (high[j] - low[j]))
+    pop = np.vstack([np.clip(x0, 0, 1), rng.random((NP - 1, k))])
+    init = (factory, tg, checkpoints)
+    pool = None
+    if workers != 1:
+        pool = multiprocessing.Pool(
+            workers if workers else os.cpu_count(), worker_init, init)
+    else:
+        worker_init(*init)
+    try:
+        fit = evaluate_all(pop, [math.inf] * NP, pool)
+        for g in range(generations):
+            trials = []
+            for i in range(NP):
+                a, b, c = rng.choice(
+                    [j for j in range(NP) if j != i], 3, replace=False)
+                mutant = np.clip(pop[a] + F * (pop[b] - pop[c]), 0, 1)
+                cross = rng.random(k) < CR
+                cross[rng.integers(k)] = True
+                trials.append(np.where(cross, mutant, pop[i]))
+            # A trial must beat its parent
+            tfit = evaluate_all(trials, fit, pool)
+            better = tfit < fit
+            pop[better] = np.array(trials)[better]
+            fit[better] = tfit[better]
+            if verbose:
+                print(f"Generation {g+1}: nrmse={fit.min()*100:.3f}% "
+                      f"runs={stats['runs']} aborted={stats['aborted']}")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    best = int(np.argmin(fit))
+    return {
+        'params': params(pop[best]), 'nrmse': float(fit[best]),
+        'runs': stats['runs'], 'aborted': stats['aborted']}
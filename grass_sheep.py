@@ -108,10 +108,17 @@ def cmd_run(args):
         '--dd', type=float, default=0, help="Delay for starvation death")
     parser.add_argument('--br', type=float, default=0.5, help="Birth rate")
     parser.add_argument('--dr', type=float, default=0.1, help="Death rate")
+    parser.add_argument(
+        '--method', default="euler", choices=["euler", "rk4", "rk45"],
+        help="Integration method")
+    parser.add_argument(
+        '--save-interval', type=float, default=None,
+        help="Save histories at this interval (default every time-step)")
     args = parser.parse_args(args[1:])
     s = sd.System(time_step=args.ts, end_time=25)
+    s.save_interval = args.save_interval
     load_model(s, delay=args.dd, br=args.br, dr=args.dr)
-    s.run()
+    s.run(method=args.method)
     s.plot_stocks(title='Grass and Sheep', size=(8,4))
     return 0
 
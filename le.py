@@ -218,17 +218,9 @@ def plot_xxy(x, y):
     plt.show()
     
 def le_test(s):
-    LE = s.nodes["LE"]
-    pop = s.nodes["pop"]
     x = range(28, 95, 2)
-    y = []
-    for le in x:
-        LE.val = le
-        s.reset()
-        s.run()
-        v = pop.hist[-1]
-        y.append(v/1000)
-        #print(f"{le}: {v}")
+    r = s.run_batch({"LE": list(x)}, outputs=["pop"])
+    y = r["pop"][:, -1] / 1000
     plot_xxy(x, y)
     
 if __name__ == "__main__":
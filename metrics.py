@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Goodness-of-fit metrics for comparing model nodes with empirical data.
+
+The histories are numpy masked arrays, with a time index. Values are
+masked where the empirical data or the model has no value (None or
+nan), or where the time is outside an interval (first, last), both
+included. The model may have many runs (runs, steps), and all metrics
+are computed for all runs at once:
+
+ - nrmse  Root mean square error, divided by the mean of the data
+ - mape   Mean absolute percent error (as a fraction)
+ - r2     Square of the correlation coefficient
+ - U      Theil's inequality coefficient
+ - UM, US, UC  Theil's inequality statistics. The fractions of the
+          mean square error from bias, unequal variation and unequal
+          covariation (UM + US + UC = 1)
+
+Example:
+
+  r = metrics.compare([s2, s], [('wpop', 'pop'), ('wle', 'le')],
+                      interval=(2000, 2025))
+  r[('wpop', 'pop')]['nrmse']   # array with one value per system
+"""
+
+import numpy as np
+
+names = ['nrmse', 'mape', 'r2', 'U', 'UM', 'US', 'UC']
+
+# window Returns a boolean array, True where first <= time <= last
+def window(time, interval=None):
+    time = np.asarray(time, dtype=float)
+    if interval is None:
+        return np.ones(time.shape, dtype=bool)
+    first, last = interval
+    return (time >= first) & (time <= last)
+
+# masked Returns the actual (empirical) and predicted (model) values
+# as masked arrays of the same shape (runs, steps), masked where any of
+# them is missing or outside the interval
+def masked(actual, predicted, time=None, interval=None):
+    a = np.asarray(actual, dtype=float)
+    p = np.atleast_2d(np.asarray(predicted, dtype=float))
+    a = np.broadcast_to(a, p.shape)
+    valid = np.isfinite(a) & np.isfinite(p)
+    if interval is not None:
+        valid &= window(time, interval)
+    return np.ma.array(a, mask=~valid), np.ma.array(p, mask=~valid)
+
+# fit Returns {metric: array(runs)} for all metrics
+def fit(actual, predicted, time=None, interval=None):
+    a, p = masked(actual, predicted, time, interval)
+    ma = a.mean(axis=-1)
+    mp = p.mean(axis=-1)
+    da = a - ma[..., None]
+    dp = p - mp[..., None]
+    sa = np.ma.sqrt((da ** 2).mean(axis=-1))
+    sp = np.ma.sqrt((dp ** 2).mean(axis=-1))
+    r = (da * dp).mean(axis=-1) / (sa * sp)
+    mse = ((p - a) ** 2).mean(axis=-1)
+    result = {
+        'nrmse': np.ma.sqrt(mse) / ma,
+        'mape': (abs((p - a) / a)).mean(axis=-1),
+        'r2': r ** 2,
+        'U': np.ma.sqrt(mse) / (
+            np.ma.sqrt((p ** 2).mean(axis=-1)) +
+            np.ma.sqrt((a ** 2).mean(axis=-1))),
+        'UM': (mp - ma) ** 2 / mse,
+        'US': (sp - sa) ** 2 / mse,
+        'UC': 2 * (1 - r) * sp * sa / mse}
+    return {k: np.ma.filled(v.astype(float), np.nan)
+            for k, v in result.items()}
+
+def nrmse(actual, predicted, time=None, interval=None):
+    a, p = masked(actual, predicted, time, interval)
+    mse = ((p - a) ** 2).mean(axis=-1)
+    return np.ma.filled(np.ma.sqrt(mse) / a.mean(axis=-1), np.nan)
+
+# series Returns the histories (runs, steps) of a node. "runs" is a
+# System, a list of Systems or the result of System.run_batch()
+def series(runs, name):
+    if type(runs) == dict:
+        return np.atleast_2d(np.asarray(runs[name], dtype=float))
+    if type(runs) not in (list, tuple):
+        runs = [runs]
+    return np.array([np.asarray(s.nodes[name].hist, dtype=float)
+                     for s in runs])
+
+# compare Returns {(empiric, model): {metric: array(runs)}} for the
+# (empiric, model) node pairs
+def compare(runs, pairs, interval=None):
+    time = series(runs, 'time')[0]
+    result = {}
+    for empiric, model in pairs:
+        result[(empiric, model)] = fit(
+            series(runs, empiric), series(runs, model), time, interval)
+    return result
+
+# report Prints the result of compare(), one line per pair and run.
+# "labels" are the names of the runs
+def report(result, labels=None):
+    print(f"{'':<14}{'':<12}" +
+          "".join([f"{n:>9}" for n in names]))
+    for (empiric, model), m in result.items():
+        for i in range(len(m['nrmse'])):
+            label = labels[i] if labels else str(i)
+            line = f"{empiric + '/' + model:<14}{label:<12}"
+            for n in names:
+                if n in ('nrmse', 'mape'):
+                    line += f"{m[n][i]*100:>8.2f}%"
+                else:
+                    line += f"{m[n][i]:>9.3f}"
+            print(line)
@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Monte Carlo runs of a System with uncertain constants.
+
+Constants (and initial values of stocks) are given probability
+distributions, and the model is run many times with samples from
+them. The runs are made in batches with System.run_batch(), and the
+statistics are accumulated batch by batch, so the histories of all
+runs are never in memory at once:
+
+ - mean and standard deviation with Welford's method (Moments)
+ - quantiles with the P-square algorithm (Quantiles)
+
+Batches are integrated with Euler, so the System must have method
+"euler" (run_batch() raises otherwise).
+
+Example:
+
+  r = montecarlo.run(
+      s, {'DCFSN': montecarlo.uniform(3.4, 4.2)}, 10000, ['pop', 'nr'])
+  r.plot(('pop', (0, 12e9)), ('nr', (0, 2e12)))
+
+The bands of the plot are the quantile ranges (fan chart).
+"""
+
+import numpy as np
+import slplot
+
+# Distributions. They return a function (rng, n) that returns n
+# samples using a numpy.random.Generator
+
+def uniform(low, high):
+    return lambda rng, n: rng.uniform(low, high, n)
+
+def normal(mean, sd):
+    return lambda rng, n: rng.normal(mean, sd, n)
+
+def triangular(low, mode, high):
+    return lambda rng, n: rng.triangular(low, mode, high, n)
+
+def lognormal(median, sigma):
+    return lambda rng, n: median * rng.lognormal(0, sigma, n)
+
+#############################################################################
+# Moments keeps the count, mean and sum of squared differences (M2)
+# for arrays of values (e.g. the histories of some nodes). A batch of
+# k samples is merged with the parallel form of Welford's method
+# (Chan et al), which is as accurate as adding them one by one.
+#############################################################################
+
+class Moments:
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    # add Adds a batch, samples along the first axis
+    def add(self, x):
+        k = len(x)
+        mean = x.mean(axis=0)
+        m2 = ((x - mean) ** 2).sum(axis=0)
+        n = self.n + k
+        delta = mean - self.mean
+        self.mean = self.mean + delta * k / n
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * k / n
+        self.n = n
+
+    def var(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else self.m2 * np.nan
+
+    def std(self):
+        return np.sqrt(self.var())
+
+#############################################################################
+# Quantiles estimates quantiles of arrays of values with the
+# P-square algorithm (Jain and Chlamtac, 1985). Five markers per value
+# and quantile are kept, whatever the number of samples. All values
+# and quantiles are updated at once, with the markers in arrays of
+# shape (5, quantiles * values).
+#############################################################################
+
+class Quantiles:
+    def __init__(self, ps, shape):
+        self.ps = list(ps)
+        self.shape = shape
+        size = int(np.prod(shape))
+        p = np.repeat(self.ps, size)
+        # Increments of the desired marker positions
+        self.dn = np.array([0 * p, p / 2, p, (1 + p) / 2, 0 * p + 1])
+        self.first = []         # The first 5 samples
+        self.q = None           # marker heights
+        self.n = None           # marker positions
+        self.desired = None     # desired marker positions
+
+    # add Adds one sample
+    def add(self, x):
+        x = np.tile(np.ravel(x), len(self.ps))
+        if self.q is None:
+            self.first.append(x)
+            if len(self.first) == 5:
+                self.q = np.sort(np.array(self.first), axis=0)
+                self.n = np.array([[0.], [1.], [2.], [3.], [4.]]) + 0 * x
+                self.desired = 4 * self.dn
+            return
+        q, n = self.q, self.n
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        # The cell k of x is q[k] <= x < q[k+1]; markers above it move
+        k = (x >= q[1]).astype(int) + (x >= q[2]) + (x >= q[3])
+        n[1:] += np.arange(1, 5)[:, None] > k
+        self.desired += self.dn
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            move = ((d >= 1) & (n[i+1] - n[i] > 1)) | \
+                ((d <= -1) & (n[i-1] - n[i] < -1))
+            if not move.any():
+                continue
+            d = np.sign(d)
+            # Piecewise parabolic (P-square) prediction
+            qp = q[i] + d / (n[i+1] - n[i-1]) * (
+                (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+            # Linear if the parabolic isn't between the neighbours
+            qd = np.where(d > 0, q[i+1], q[i-1])
+            nd = np.where(d > 0, n[i+1], n[i-1])
+            ql = q[i] + d * (qd - q[i]) / (nd - n[i])
+            qn = np.where((q[i-1] < qp) & (qp < q[i+1]), qp, ql)
+            q[i] = np.where(move, qn, q[i])
+            n[i] += np.where(move, d, 0)
+
+    # get Returns the estimate for quantile p
+    def get(self, p):
+        j = self.ps.index(p)
+        size = int(np.prod(self.shape))
+        if self.q is None:
+            # Fewer than 5 samples, use them all
+            a = np.array(self.first)[:, j*size:(j+1)*size]
+            return np.quantile(a, p, axis=0).reshape(self.shape)
+        return self.q[2, j*size:(j+1)*size].reshape(self.shape)
+
+#############################################################################
+# Result holds the statistics of a Monte Carlo run per output node.
+#############################################################################
+
+class Result:
+    def __init__(self, s, outputs, quantiles, time):
+        self.system = s
+        self.outputs = list(outputs)
+        self.time = time
+        self.moments = Moments((len(outputs), len(time)))
+        self.quantiles = Quantiles(quantiles, (len(outputs), len(time)))
+
+    # add Adds a batch {name: array(N, steps)}
+    def add(self, hist):
+        x = np.stack([hist[n] for n in self.outputs], axis=1)
+        self.moments.add(x)
+        for sample in x:
+            self.quantiles.add(sample)
+
+    @property
+    def runs(self):
+        return self.moments.n
+
+    def mean(self, name):
+        return self.moments.mean[self.outputs.index(name)]
+
+    def std(self, name):
+        return self.moments.std()[self.outputs.index(name)]
+
+    def quantile(self, name, p):
+        return self.quantiles.get(p)[self.outputs.index(name)]
+
+    # axis Returns a slplot.Axis for a node with the median as values,
+    # and the quantile ranges as bands, widest first
+    def axis(self, name, lim=None, formatter=None):
+        n = self.system.nodes[name]
+        ps = sorted(self.quantiles.ps)
+        bands = [
+            (self.quantile(name, lo), self.quantile(name, hi))
+            for lo, hi in zip(ps, reversed(ps)) if lo < hi]
+        median = self.quantile(name, 0.5) if 0.5 in ps else self.mean(name)
+        return slplot.Axis(
+            n.detail, n.unit, list(median), lim=lim, y_offset=65,
+            formatter=formatter, bands=bands)
+
+    # plot Plots fan charts. Nodes are names or (name, lim)
+    def plot(self, *nodes, title=None, size=(10,5), formatter="eng"):
+        fmt = slplot.engfmt if formatter == "eng" else None
+        X = slplot.Axis(self.system.time_unit, values=list(self.time))
+        Y = []
+        for n in nodes:
+            lim = None
+            if type(n) is tuple:
+                n, lim = n
+            Y.append(self.axis(n, lim, fmt))
+        slplot.plot(X, Y, title, size)
+
+# run Runs a system "runs" times with constants (or initial values of
+# stocks) sampled from distributions {name: distribution}. A tuple of
+# names get the same samples, e.g. {('NRI', 'nr'): uniform(1e12,
+# 2e12)}. The runs are made "batch" at the time, and a Result with
+# statistics for the "outputs" nodes is returned. The System itself
+# is not modified
+def run(
+        s, distributions, runs, outputs, batch=1000,
+        quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), seed=None,
+        end_time=None):
+    rng = np.random.default_rng(seed)
+    result = None
+    done = 0
+    while done < runs:
+        k = min(batch, runs - done)
+        params = {}
+        for names, d in distributions.items():
+            v = d(rng, k)
+            for name in names if type(names) == tuple else (names,):
+                params[name] = v
+        hist = s.run_batch(params, end_time, ['time'] + list(outputs))
+        if result is None:
+            result = Result(s, outputs, quantiles, hist['time'][0])
+        result.add(hist)
+        done += k
+    return result
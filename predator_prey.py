@@ -25,11 +25,11 @@ def csl2float(s, l):
 def load_model(s, c, i):
     # alpha,beta,gamma,delta in the Lotka–Volterra equations
     s.default_cat = "prey"
-    prbr = s.addConstant("prbr", sd.C, detail='Prey birth rate', val=c[0])
-    pdeff = s.addConstant("pdeff", sd.C, detail='Predator effect', val=c[1])
+    s.addConstant("prbr", sd.C, detail='Prey birth rate', val=c[0])
+    s.addConstant("pdeff", sd.C, detail='Predator effect', val=c[1])
     s.default_cat = "predator"
-    wdr = s.addConstant("pddr", sd.C, detail='Predator death rate', val=c[2])
-    preff = s.addConstant("preff", sd.C, detail='Prey effect', val=c[3])
+    s.addConstant("pddr", sd.C, detail='Predator death rate', val=c[2])
+    s.addConstant("preff", sd.C, detail='Prey effect', val=c[3])
 
     predator = s.addStock("predator", detail='Predators', val=i[1])
     s.default_cat = "prey"
@@ -41,13 +41,14 @@ def load_model(s, c, i):
     pdb = s.addFlow("predator_births")
     pdd = s.addFlow("predator_deaths")
 
-    s.add_equation(sd.f_mul, prb, [prey, prbr], ['',''])
-    s.add_equation(sd.f_mul, prd, [pdeff, prey, predator], ['','',''])
-    s.add_equation(sd.f_mul, pdb, [preff, predator, prey], ['','',''])
-    s.add_equation(sd.f_mul, pdd, [predator, wdr], ['',''])
+    s.add_equation("prey*prbr", prb, edge_labels=['',''])
+    s.add_equation("pdeff*prey*predator", prd, edge_labels=['','',''])
+    s.add_equation("preff*predator*prey", pdb, edge_labels=['','',''])
+    s.add_equation("predator*pddr", pdd, edge_labels=['',''])
 
-    s.add_equation(sd.f_diff, prey, [prb, prd], ['+','-'])
-    s.add_equation(sd.f_diff, predator, [pdb, pdd], ['+','-'])
+    s.add_equation("prey_births - prey_deaths", prey, edge_labels=['+','-'])
+    s.add_equation(
+        "predator_births - predator_deaths", predator, edge_labels=['+','-'])
 
 # ----------------------------------------------------------------------
 # Commands;
@@ -63,6 +64,15 @@ def cmd_run(args):
         prog="run", description=cmd_run.__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--ts', type=float, default=0.001, help="time-step")
+    parser.add_argument(
+        '--engine', default="compile", choices=["interpret", "compile"],
+        help="Evaluation engine")
+    parser.add_argument(
+        '--method', default="euler", choices=["euler", "rk4", "rk45"],
+        help="Integration method")
+    parser.add_argument(
+        '--save-interval', type=float, default=None,
+        help="Save histories at this interval (default every time-step)")
     parser.add_argument(
         '--c', default="1.1,0.4,0.4,0.1",
         help="constants: alpha,beta,gamma,delta")
@@ -70,8 +80,9 @@ def cmd_run(args):
         '--i', default="10,10", help="initial values: prey,predator")
     args = parser.parse_args(args[1:])
     s = sd.System(time_step=args.ts, end_time=100, time_unit="time")
+    s.save_interval = args.save_interval
     load_model(s, csl2float(args.c, 4), csl2float(args.i, 2))
-    s.run()
+    s.run(engine=args.engine, method=args.method)
     max = max_pop(s) * 1.1
     nodes = [("prey",(0,max)), ("predator",(0,max))]
     s.plot(*nodes, title='Predator and Prey', size=(8,4))
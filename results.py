@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Results of runs in binary files.
+
+The histories are stored as typed columns (float64, None is NaN) in a
+directory, one numpy .npy file per node with the shape (runs, steps),
+and the metadata of the nodes (name, type, unit, cat, detail) and the
+time unit in "meta.json". The .npy files are memory mapped when
+read, so a large ensemble can be sliced by node, run and time
+without reading it all.
+
+A single run:
+
+  results.write("run1", s)            # all nodes with history
+  r = results.read("run1")
+  r.nodes['pop'].hist                 # array (steps)
+  sd.plot_nodes(r, r2, nodes=[('pop', (0, 10e9))])
+
+An ensemble, written batch by batch:
+
+  w = results.Writer("mc", s, ['pop', 'nr'], runs=100000)
+  for params in batches:
+      w.add(s.run_batch(params, outputs=w.names))
+  w.close()
+  r = results.read("mc")
+  r.slice('pop', runs=slice(0, 10), interval=(2000, 2050))
+  r.run(5).nodes['pop'].hist          # run 5, e.g. for plot_nodes()
+
+Results have a "nodes" dict and a "time_unit" as a System, so
+they can be used in sd.plot_nodes().
+"""
+
+import json
+import os
+import numpy as np
+
+# node_meta Returns the metadata of a node (as Node.dict() without
+# values)
+def node_meta(n):
+    return {k: v for k, v in n.dict().items() if k not in ('val', 'hist')}
+
+#############################################################################
+# Writer creates a results directory with room for "runs" runs of the
+# nodes, and writes the histories as they are added. The files are
+# memory mapped, so nothing is kept in memory
+#############################################################################
+
+class Writer:
+    def __init__(self, path, s, nodes=None, runs=1, steps=None):
+        if nodes is None:
+            nodes = [n.name for n in s.nodes.values() if hasattr(n, 'hist')]
+        self.names = ['time'] + [n for n in nodes if n != 'time']
+        if steps is None:
+            it = s.nodes['time'].hist[0]
+            ts = s.nodes['TS'].val
+            steps = int((s.end_time - it) / ts)
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.runs = runs
+        self.count = 0
+        self.meta = {
+            'time_unit': s.time_unit, 'runs': runs, 'nodes': []}
+        self.columns = {}
+        for k, name in enumerate(self.names):
+            m = node_meta(s.nodes[name])
+            m['file'] = f"n{k}.npy"
+            self.meta['nodes'].append(m)
+            self.columns[name] = np.lib.format.open_memmap(
+                os.path.join(path, m['file']), mode='w+',
+                dtype=np.float64, shape=(runs, steps))
+
+    # add Adds runs, a dict {name: array(N, steps)} as returned by
+    # System.run_batch(), or a System after run()
+    def add(self, hist):
+        if type(hist) != dict:
+            hist = {name: np.asarray(hist.nodes[name].hist, dtype=float)
+                    for name in self.names}
+        k = None
+        for name in self.names:
+            h = np.atleast_2d(hist[name])
+            k = len(h)
+            self.columns[name][self.count:self.count+k] = h
+        self.count += k
+
+    def close(self):
+        for c in self.columns.values():
+            c.flush()
+        self.columns = {}
+        self.meta['runs'] = self.count
+        with open(os.path.join(self.path, "meta.json"), 'w') as f:
+            json.dump(self.meta, f, indent='\t')
+
+# write Writes the histories of a System (after run()). The histories
+# may have different lengths (e.g. delays), they are padded with NaN
+def write(path, s, nodes=None):
+    if nodes is None:
+        nodes = [n.name for n in s.nodes.values() if hasattr(n, 'hist')]
+    hist = {n: np.asarray(s.nodes[n].hist, dtype=float) for n in nodes}
+    hist['time'] = np.asarray(s.nodes['time'].hist, dtype=float)
+    steps = max([len(h) for h in hist.values()])
+    hist = {n: np.pad(h, (0, steps - len(h)), constant_values=np.nan)
+            for n, h in hist.items()}
+    w = Writer(path, s, nodes, runs=1, steps=steps)
+    w.add(hist)
+    w.close()
+
+#############################################################################
+# Results is an open results directory. Columns are memory mapped when
+# they are used. "run" selects one run, and the nodes then have
+# a 1-dimensional "hist"
+#############################################################################
+
+class Node:
+    def __init__(self, results, meta):
+        self.results = results
+        self.name = meta['name']
+        self.type = meta.get('type')
+        self.unit = meta.get('unit')
+        self.cat = meta.get('cat')
+        self.detail = meta.get('detail')
+
+    # hist The history of the selected run, or of all runs
+    @property
+    def hist(self):
+        column = self.results.column(self.name)
+        if self.results.selected is None:
+            return column
+        return column[self.results.selected]
+
+class Results:
+    def __init__(self, path, selected=None):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.time_unit = self.meta['time_unit']
+        self.runs = self.meta['runs']
+        self.files = {m['name']: m['file'] for m in self.meta['nodes']}
+        self.names = list(self.files)
+        self.columns = {}
+        # A single run is selected by default
+        if selected is None and self.runs == 1:
+            selected = 0
+        self.selected = selected
+        self.nodes = {m['name']: Node(self, m) for m in self.meta['nodes']}
+
+    # column Returns the (runs, steps) array of a node
+    def column(self, name):
+        if name not in self.columns:
+            c = np.load(
+                os.path.join(self.path, self.files[name]), mmap_mode='r')
+            self.columns[name] = c[:self.runs]
+        return self.columns[name]
+
+    # run Returns the results with run i selected
+    def run(self, i):
+        r = Results.__new__(Results)
+        r.__dict__.update(self.__dict__)
+        r.selected = i
+        r.nodes = {name: Node(r, m) for name, m in zip(
+            self.names, self.meta['nodes'])}
+        return r
+
+    # slice Returns the values of a node for some runs (index or
+    # slice, default all) within a time interval (first, last)
+    def slice(self, name, runs=None, interval=None):
+        c = self.column(name)
+        if runs is not None:
+            c = c[runs]
+        if interval is None:
+            return np.asarray(c)
+        t = self.column('time')[0]
+        i, j = np.searchsorted(t, interval[0]), \
+            np.searchsorted(t, interval[1], side='right')
+        return np.asarray(c[..., i:j])
+
+def read(path):
+    return Results(path)
@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Global sensitivity analysis of a System over constants.
+
+Factors are constants (or initial values of stocks) with a range
+{name: (low, high)}. A tuple of names is one factor, e.g. ('NRI',
+'nr') for a constant that is also the initial value of a stock. The
+effect is measured on output nodes, as the mean value within time
+windows [(from, to),...]. The default window is the last time step.
+
+ - morris() Elementary effects (Morris screening). mu* (the mean
+   absolute effect) ranks the factors, sigma shows non-linearity or
+   interactions. Effects are per unit of the (normalized) range.
+ - sobol() First order (S1) and total order (ST) Sobol indices,
+   estimated as Saltelli (2010) and Jansen (1999).
+
+All points are run with System.run_batch(), "batch" at the time,
+so only the Euler method can be used.
+Results are dicts {(node, window): {factor: {index: value}}}, and
+report() prints them.
+
+Example:
+
+  r = sensitivity.morris(
+      s, {'DCFSN': (3.4, 4.2), 'LEN': (25, 31)}, ['pop'],
+      windows=[(2000, 2025), (2075, 2100)])
+  sensitivity.report(r)
+"""
+
+import numpy as np
+
+# label Returns the name used for a factor
+def label(names):
+    return names[0] if type(names) == tuple else names
+
+# evaluate Runs the points (n, k) in the unit hypercube, scaled to the
+# ranges, and returns {(node, window): array(n)}
+def evaluate(s, ranges, points, outputs, windows, batch, end_time):
+    low = np.array([r[0] for r in ranges.values()])
+    high = np.array([r[1] for r in ranges.values()])
+    x = low + points * (high - low)
+    y = {(o, w): [] for o in outputs for w in windows}
+    for b in range(0, len(x), batch):
+        params = {}
+        for j, names in enumerate(ranges):
+            for name in names if type(names) == tuple else (names,):
+                params[name] = x[b:b+batch, j]
+        hist = s.run_batch(params, end_time, ['time'] + list(outputs))
+        time = hist['time'][0]
+        for w in windows:
+            if w is None:
+                mask = time == time[-1]
+            else:
+                mask = (time >= w[0]) & (time <= w[1])
+            for o in outputs:
+                y[(o, w)].append(hist[o][:, mask].mean(axis=1))
+    return {k: np.concatenate(v) for k, v in y.items()}
+
+# morris Elementary effects from r trajectories on a grid of p levels
+def morris(
+        s, ranges, outputs, r=20, p=4, windows=[None], seed=None,
+        batch=1000, end_time=None):
+    rng = np.random.default_rng(seed)
+    k = len(ranges)
+    delta = p / (2 * (p - 1))
+    levels = np.arange(p) / (p - 1)
+    points, steps = [], []
+    for t in range(r):
+        # Start on the grid where x + delta is still in [0,1]
+        x = rng.choice(levels[levels <= 1 - delta + 1e-12], k)
+        points.append(x.copy())
+        for i in rng.permutation(k):
+            d = delta if x[i] + delta <= 1 + 1e-12 else -delta
+            x[i] += d
+            points.append(x.copy())
+            steps.append((i, d))
+    y = evaluate(
+        s, ranges, np.array(points), outputs, windows, batch, end_time)
+    result = {}
+    for key, v in y.items():
+        v = v.reshape(r, k + 1)
+        ee = [[] for i in range(k)]
+        for t in range(r):
+            for j in range(k):
+                i, d = steps[t * k + j]
+                ee[i].append((v[t, j+1] - v[t, j]) / d)
+        ee = np.array(ee)
+        result[key] = {
+            label(names): {
+                'mu': ee[i].mean(),
+                'mu*': np.abs(ee[i]).mean(),
+                'sigma': ee[i].std(ddof=1)}
+            for i, names in enumerate(ranges)}
+    return result
+
+# sobol Sobol indices from n base samples, n * (k + 2) runs
+def sobol(
+        s, ranges, outputs, n=1000, windows=[None], seed=None,
+        batch=1000, end_time=None):
+    rng = np.random.default_rng(seed)
+    k = len(ranges)
+    A = rng.random((n, k))
+    B = rng.random((n, k))
+    AB = []
+    for i in range(k):
+        ABi = A.copy()
+        ABi[:, i] = B[:, i]
+        AB.append(ABi)
+    y = evaluate(
+        s, ranges, np.concatenate([A, B] + AB), outputs, windows, batch,
+        end_time)
+    result = {}
+    for key, v in y.items():
+        fA, fB = v[:n], v[n:2*n]
+        var = np.concatenate([fA, fB]).var()
+        result[key] = {}
+        for i, names in enumerate(ranges):
+            fABi = v[(2 + i) * n:(3 + i) * n]
+            result[key][label(names)] = {
+                'S1': np.mean(fB * (fABi - fA)) / var,
+                'ST': np.mean((fA - fABi) ** 2) / 2 / var}
+    return result
+
+# report Prints the result of morris() or sobol(), factors sorted by
+# mu* or S1
+def report(result):
+    for (node, window), factors in result.items():
+        w = "end" if window is None else f"{window[0]:g}-{window[1]:g}"
+        indexes = list(next(iter(factors.values())))
+        first = 'mu*' if 'mu*' in indexes else indexes[0]
+        print(f"{node} ({w})")
+        print(f"  {'':<10}" + "".join([f"{i:>12}" for i in indexes]))
+        for name, v in sorted(
+                factors.items(), key=lambda f: -abs(f[1][first])):
+            print(f"  {name:<10}" +
+                  "".join([f"{v[i]:>12.4g}" for i in indexes]))
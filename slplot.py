@@ -4,9 +4,19 @@ Provides a very simple line plot function using "matplotlib".
 The function allows multiple Y-axis with individual value ranges, and
 optionally a secondary line (dashed) for comparison.
 
+Bands (e.g. percentile ranges) can be shown as shaded areas around a
+line, which makes a fan chart.
+
 The plot is displayed and let the user save with the built-in save function.
 Simple animations are possible.
 
+Long series (e.g. 100000 values with a small time step) are
+downsampled to about two points per pixel of the figure width before
+they are plotted, which keeps rendering and saved files (svg) small.
+Lines keep the min and max of each bucket of values (or use LTTB,
+Largest-Triangle-Three-Buckets), and bands keep their envelope. Gaps
+(None) are kept as gaps.
+
 The __main__ function in this file serves as test and example.
 """
 
@@ -14,6 +24,7 @@ The __main__ function in this file serves as test and example.
 # https://matplotlib.org/stable/gallery/text_labels_and_annotations/engineering_formatter.html
 
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.ticker import EngFormatter
 from typing import NamedTuple
 
@@ -33,9 +44,13 @@ class Axis(NamedTuple):
     y_offset: int = 50
     formatter: any = None
     cvalues: [any] = []
+    # [(low values, high values),...] shaded around the line. Widest first
+    bands: [any] = []
 
 # x: Axis, y: Axis[]
-def plot(x, y, title=None, size=(10,5), show=True):
+def plot(
+        x, y, title=None, size=(10,5), show=True, points=None,
+        method="minmax"):
     """
     Create a line plot with multiple Y-axis.
 
@@ -44,10 +59,14 @@ def plot(x, y, title=None, size=(10,5), show=True):
     :param title: The title of the figure
     :param size: Size of the figure (inches)
     :param show: If the plot should be shown. Set to False for automatic saves and animations
+    :param points: Max points per line. Default two per pixel of the figure width. 0 plots all values
+    :param method: Downsampling of lines, "minmax" or "lttb"
     """
     fig = plt.gcf()         # (Get Current Figure)
     fig.set_size_inches(size)
     fig.clear()
+    if points is None:
+        points = int(2 * size[0] * fig.dpi)
     if title:
         fig.suptitle(title)
     ax = plt.axes()
@@ -57,12 +76,12 @@ def plot(x, y, title=None, size=(10,5), show=True):
     for i, Y in enumerate(y):
         if i > 1:
             offset += Y.y_offset
-        plotY(ax, x.values, Y, i, offset)
+        plotY(ax, x.values, Y, i, offset, points, method)
     fig.tight_layout()
     if show:
         plt.show()
 
-def plotY(ax, vx, y, i, offset):
+def plotY(ax, vx, y, i, offset, points=0, method="minmax"):
     """
     Internal function. Adds an Y-axis
     """
@@ -77,12 +96,114 @@ def plotY(ax, vx, y, i, offset):
         ax.set(ylabel=f'{y.title} ({y.unit})')
     else:
         ax.set(ylabel=f'{y.title}')
-    p, = ax.plot(vx, y.values, f'C{i}')
+    for j, (low, high) in enumerate(y.bands):
+        ax.fill_between(
+            *envelope(vx, low, high, points), color=f'C{i}',
+            alpha=0.15 + 0.1 * j, linewidth=0)
+    p, = ax.plot(*downsample(vx, y.values, points, method), f'C{i}')
     ax.yaxis.label.set_color(p.get_color())
     ax.tick_params(axis='y', colors=p.get_color())
     # Compare values
-    if y.cvalues:
-        ax.plot(vx, y.cvalues, f'C{i}--', linewidth=0.5)
+    if len(y.cvalues):
+        ax.plot(
+            *downsample(vx, y.cvalues, points, method), f'C{i}--',
+            linewidth=0.5)
+
+def downsample(vx, vy, points, method="minmax"):
+    """
+    Returns (x, y) with at most about "points" values of a line. Each
+    run of values between gaps (None) gets its share of the points,
+    and the gaps are kept (a NaN between the runs). Short series are
+    returned as they are.
+    """
+    if not points or len(vx) <= points:
+        return vx, vy
+    x = np.asarray(vx, dtype=float)
+    y = np.array(vy, dtype=float)
+    valid = np.isfinite(y)
+    # Runs of valid values [(start, end)]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], valid, [0]))))
+    runs = list(zip(edges[::2], edges[1::2]))
+    total = valid.sum()
+    xs, ys = [], []
+    for start, end in runs:
+        if xs:
+            xs.append([x[start - 1]])
+            ys.append([np.nan])
+        n = max(2, points * (end - start) // total)
+        if method == "lttb":
+            k = lttb(x[start:end], y[start:end], n)
+        else:
+            k = minmax(y[start:end], n)
+        xs.append(x[start:end][k])
+        ys.append(y[start:end][k])
+    if not xs:
+        return vx, vy
+    return np.concatenate(xs), np.concatenate(ys)
+
+def buckets(length, n):
+    """
+    Returns the start indexes of n buckets of about the same size
+    """
+    return np.linspace(0, length, n + 1).astype(int)[:-1]
+
+def minmax(y, points):
+    """
+    Returns the indexes of the min and max values in each bucket (in
+    order), with the first and last values
+    """
+    if len(y) <= points:
+        return np.arange(len(y))
+    starts = buckets(len(y), max(1, points // 2))
+    ends = list(starts[1:]) + [len(y)]
+    k = [0]
+    for a, b in zip(starts, ends):
+        lo = a + np.argmin(y[a:b])
+        hi = a + np.argmax(y[a:b])
+        k += [min(lo, hi), max(lo, hi)]
+    k.append(len(y) - 1)
+    return np.unique(k)
+
+def lttb(x, y, points):
+    """
+    Largest-Triangle-Three-Buckets. Returns the indexes of the first
+    and last values, and the value in each bucket between that makes
+    the largest triangle with the value selected before and the
+    average of the next bucket
+    """
+    if len(y) <= points or points < 3:
+        return np.arange(len(y))
+    starts = buckets(len(y) - 2, points - 2) + 1
+    ends = list(starts[1:]) + [len(y) - 1]
+    k = [0]
+    for j, (a, b) in enumerate(zip(starts, ends)):
+        if j + 1 < len(starts):
+            c, d = ends[j], ends[j + 1]
+            cx, cy = x[c:d].mean(), y[c:d].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        px, py = x[k[-1]], y[k[-1]]
+        area = np.abs(
+            (px - cx) * (y[a:b] - py) - (px - x[a:b]) * (cy - py))
+        k.append(a + int(np.argmax(area)))
+    k.append(len(y) - 1)
+    return np.array(k)
+
+def envelope(vx, low, high, points):
+    """
+    Returns (x, low, high) of a band with at most about "points"
+    values, the min of low and max of high at the start and end of
+    each bucket. Buckets where all values are missing are gaps
+    """
+    if not points or len(vx) <= points:
+        return vx, low, high
+    x = np.asarray(vx, dtype=float)
+    starts = buckets(len(x), max(1, points // 2))
+    ends = np.append(starts[1:], len(x)) - 1
+    lo = np.fmin.reduceat(np.array(low, dtype=float), starts)
+    hi = np.fmax.reduceat(np.array(high, dtype=float), starts)
+    return (np.column_stack((x[starts], x[ends])).ravel(),
+            np.repeat(lo, 2), np.repeat(hi, 2))
 
 
 if __name__ == '__main__':
@@ -94,6 +215,13 @@ if __name__ == '__main__':
             y1 = Axis("USSR", "mtoe", [10,40,45,30,None,None],(0,100))
             y2 = Axis("USA", "mtoe", [60,50,65,65,68,72],(0,100))
             plot(x, [y1,y2], title="Incomplete values")
+        case "bands":
+            # A fan chart
+            x = Axis("Year", values=[2020,2021,2022,2023,2024])
+            y1 = Axis(
+                "Apples", "ton", [5,5,3,6,10], (0,16),
+                bands=[([3,2,1,2,5],[7,8,6,10,14]), ([4,4,2,5,8],[6,6,4,7,12])])
+            plot(x, [y1], title="Fan chart")
         case _:
             x = Axis("Year", values=[2020,2021,2022,2023,2024])
             # Plot compare values
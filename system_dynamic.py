@@ -49,8 +49,21 @@
 # - Create/dump/update from dict
 # ...and more
 
+import ast
+import functools
 import math
+import os
+import copy
+import types
+import itertools
+import json
+import multiprocessing
+import time
+from array import array
+from bisect import bisect_left
+import numpy as np
 import slplot
+import metrics
 
 C = "CONSTANT"
 CT = "TABLE OF CONSTANTS"
@@ -58,6 +71,385 @@ CT = "TABLE OF CONSTANTS"
 class NodeAlreadyExistsError(Exception):
     pass
 
+class AlgebraicLoopError(Exception):
+    pass
+
+#############################################################################
+# History is a list-like sequence of node values. The values are
+# stored in a typed array('d') which is preallocated by System.run()
+# for the number of steps, and then filled by index. None is stored
+# as NaN, and is read back as None. Slices and "+" return lists.
+#############################################################################
+
+class History:
+    def __init__(self, values=()):
+        self.buf = array('d')
+        self.n = 0
+        if len(values):
+            self.extend(values)
+
+    # reserve Make room for "size" more values
+    def reserve(self, size):
+        free = len(self.buf) - self.n
+        if free < size:
+            self.buf.frombytes(bytes(8 * (size - free)))
+
+    def append(self, v):
+        try:
+            self.buf[self.n] = v
+        except (IndexError, TypeError):
+            self.put(v)
+        self.n += 1
+
+    # put Store v when the buffer is full, or v is None
+    def put(self, v):
+        if self.n == len(self.buf):
+            self.buf.append(0)
+        self.buf[self.n] = math.nan if v is None else v
+
+    def extend(self, values):
+        if type(values) == np.ndarray:
+            a = array('d', values.astype(float).tobytes())
+        else:
+            a = array('d', [math.nan if v is None else v for v in values])
+        self.buf[self.n:self.n+len(a)] = a
+        self.n += len(a)
+
+    def pop(self, i=-1):
+        v = self[i]
+        i = i + self.n if i < 0 else i
+        self.buf[i:self.n-1] = self.buf[i+1:self.n]
+        self.n -= 1
+        return v
+
+    def copy(self):
+        h = History()
+        h.buf = self.buf[:self.n]
+        h.n = self.n
+        return h
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if type(i) == slice:
+            return self.tolist()[i]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("History index out of range")
+        v = self.buf[i]
+        return None if v != v else v
+
+    def __setitem__(self, i, v):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("History index out of range")
+        self.buf[i] = math.nan if v is None else v
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return np.frombuffer(self.buf, count=self.n).astype(dtype or float)
+
+    def tolist(self):
+        return [None if v != v else v for v in self.buf[:self.n]]
+
+#############################################################################
+# Sampler switches Node.save on and off during a run, so nodes save
+# their history every k-th step only. "every" is {node: k} (see
+# System.save_every()). Steps are counted from init time, first is
+# the step where the run starts. Flows and delays are saved at step
+# 0, k, 2k... and stocks with the value *after* the step, so the
+# histories are aligned with the time stock. Nodes are grouped by k,
+# and are only touched when the group turns on or off
+#############################################################################
+
+class Sampler:
+    def __init__(self, every, first=0):
+        self.first = first
+        self.groups = {}
+        for n, k in every.items():
+            offset = 1 if type(n) == NodeStock else 0
+            self.groups.setdefault((k, offset), []).append(n)
+        self.on = {g: True for g in self.groups}
+
+    # step Sets Node.save for step i of the run
+    def step(self, i):
+        for (k, offset), nodes in self.groups.items():
+            due = (self.first + i + offset) % k == 0
+            if due != self.on[(k, offset)]:
+                self.on[(k, offset)] = due
+                for n in nodes:
+                    n.save = due
+
+    # done Turns Node.save on again
+    def done(self):
+        for nodes in self.groups.values():
+            for n in nodes:
+                n.save = True
+
+#############################################################################
+# Profile records the number of evaluations and the time spent in each
+# node in System.run(profile=...). The nodes are then evaluated one by
+# one, as the interpret engine does, since the other engines have no
+# per-node calls to time. Table lookups (f_tab, f_tabclip or any call
+# of a Table) are counted and timed for the node they are made from;
+# that time is part of the node time. Nothing is added to a run
+# without a Profile. A Profile can be used for many runs, the numbers
+# add up. Example:
+#
+#   p = sd.Profile()
+#   s.run(profile=p)
+#   p.report(top=20)
+#   json.dump(p.dict(), f)
+#############################################################################
+
+class Profile:
+    def __init__(self):
+        # node -> [calls, time, table calls, table time]
+        self.nodes = {}
+        self.steps = 0
+        self.time = 0.0         # time of the profiled steps
+        self.current = None     # the entry of the node being evaluated
+        self.lookups = None     # the Table methods while profiling
+
+    # start Starts a run of the ranked nodes. Table lookups are timed
+    # until stop()
+    def start(self, rank):
+        for n in rank:
+            self.nodes.setdefault(n, [0, 0.0, 0, 0.0])
+        self.lookups = (Table.__call__, Table.clip)
+        def timed(f):
+            def lookup(tab, x):
+                t = time.perf_counter()
+                try:
+                    return f(tab, x)
+                finally:
+                    if self.current:
+                        self.current[3] += time.perf_counter() - t
+                        self.current[2] += 1
+            return lookup
+        Table.__call__, Table.clip = [timed(f) for f in self.lookups]
+
+    def stop(self):
+        Table.__call__, Table.clip = self.lookups
+        self.current = None
+
+    # eval Evaluates the ranked nodes one step
+    def eval(self, rank, ts):
+        clock = time.perf_counter
+        start = clock()
+        for n in rank:
+            self.current = entry = self.nodes[n]
+            t = clock()
+            n.eval(ts)
+            entry[1] += clock() - t
+            entry[0] += 1
+        self.current = None
+        self.time += clock() - start
+        self.steps += 1
+
+    # dict Returns the profile for serialization (json). Nodes and
+    # categories have calls, time, mean (time per call), table_calls
+    # and table_time, times are in seconds
+    def dict(self):
+        def stats(calls, total, tcalls, ttime):
+            return {
+                'calls': calls, 'time': total,
+                'mean': total / calls if calls else 0.0,
+                'table_calls': tcalls, 'table_time': ttime}
+        nodes = {}
+        cats = {}
+        for n, (calls, total, tcalls, ttime) in self.nodes.items():
+            nodes[n.name] = stats(calls, total, tcalls, ttime)
+            nodes[n.name]['cat'] = n.cat
+            c = cats.setdefault(str(n.cat), [0, 0.0, 0, 0.0])
+            for i, v in enumerate((calls, total, tcalls, ttime)):
+                c[i] += v
+        return {
+            'steps': self.steps, 'time': self.time, 'nodes': nodes,
+            'cats': {cat: stats(*c) for cat, c in cats.items()}}
+
+    # report Prints the nodes (the "top" ones) and the categories,
+    # sorted by time
+    def report(self, top=None):
+        d = self.dict()
+        print(f"{d['steps']} steps in {d['time']:.3f} s")
+        for title, rows in (('node', d['nodes']), ('cat', d['cats'])):
+            print(f"{title:<14}{'calls':>9}{'time s':>10}{'mean us':>10}"
+                  f"{'%':>7}{'tables':>9}{'table s':>10}")
+            rows = sorted(rows.items(), key=lambda r: -r[1]['time'])
+            for name, r in rows[:top] if title == 'node' else rows:
+                share = r['time'] / d['time'] * 100 if d['time'] else 0
+                print(f"{name:<14}{r['calls']:>9}{r['time']:>10.4f}"
+                      f"{r['mean']*1e6:>10.2f}{share:>6.1f}%"
+                      f"{r['table_calls']:>9}{r['table_time']:>10.4f}")
+
+#############################################################################
+# Tracer records (step, time, node, value) of traced nodes (see
+# System.trace()) in a preallocated ring buffer of "size" records.
+# When it is full the oldest records are overwritten, or with a
+# "path", the buffer is appended to that file so nothing is lost.
+# Steps are counted from init time and are the index in the
+# histories, so a stock is recorded at the step after the one that
+# computed it (as time). Recording can be limited to a window of
+# "steps" or "times" (first, last), to every k-th step ("every"), and
+# to after a "trigger". A trigger is a function (node name, value) ->
+# bool that is called for the records of all traced nodes, e.g.
+# crosses(). Recording starts with the record where it returns True,
+# and stops "after" steps later (if given). Example:
+#
+#   t = sd.Tracer(times=(2000, 2100), trigger=sd.crosses('pop', 7e9))
+#   s.trace('pop', 'nr', tracer=t)
+#   s.run()
+#   t.query('nr', times=(2020, 2030))['value']
+#   t.series('pop')             # (times, values)
+#############################################################################
+
+record_type = np.dtype([
+    ('step', np.int64), ('time', np.float64), ('node', np.int32),
+    ('value', np.float64)])
+
+class Tracer:
+    def __init__(
+            self, size=1 << 16, path=None, steps=None, times=None, every=1,
+            trigger=None, after=None):
+        self.buf = np.zeros(size, dtype=record_type)
+        self.count = 0          # records, including overwritten ones
+        self.written = 0        # records in the file
+        self.path = path
+        if path:
+            open(path, 'wb').close()
+        self.steps = steps
+        self.times = times
+        self.every = every
+        self.trigger = trigger
+        self.after = after
+        self.triggered = None   # the step where the trigger fired
+        self.names = []         # the node of a record is an index
+        self.index = {}         # node -> (index, step offset)
+        self.step = 0           # the current step, set by the engines
+        self.t0, self.ts = 0.0, 1.0
+        self.window = (0, math.inf)
+
+    # start Sets the time of step 0 and the time step. Called by
+    # System.run()
+    def start(self, t0, ts):
+        self.t0, self.ts = t0, ts
+        first, last = self.steps if self.steps else (0, math.inf)
+        if self.times:
+            first = max(first, math.ceil((self.times[0] - t0) / ts - 1e-9))
+            last = min(last, math.floor((self.times[1] - t0) / ts + 1e-9))
+        self.window = (first, last)
+
+    def add(self, n):
+        self.index[n] = (len(self.names), 1 if type(n) == NodeStock else 0)
+        self.names.append(n.name)
+        return self.index[n]
+
+    # record Records the value of a node in this step (or "step")
+    def record(self, n, value, step=None):
+        k, offset = self.index.get(n) or self.add(n)
+        step = (self.step if step is None else step) + offset
+        if not self.window[0] <= step <= self.window[1] or step % self.every:
+            return
+        if self.trigger:
+            if self.triggered is None:
+                if not self.trigger(n.name, value):
+                    return
+                self.triggered = step
+            elif self.after is not None and step > self.triggered + self.after:
+                return
+        i = self.count % len(self.buf)
+        self.buf[i] = (
+            step, self.t0 + step * self.ts, k,
+            math.nan if value is None else value)
+        self.count += 1
+        if self.path and i == len(self.buf) - 1:
+            self.flush()
+
+    # flush Appends the records that are not written to the file, and
+    # writes the node names to path.json
+    def flush(self):
+        if not self.path:
+            return
+        i = self.written % len(self.buf)
+        with open(self.path, 'ab') as f:
+            self.buf[i:i + self.count - self.written].tofile(f)
+        self.written = self.count
+        with open(self.path + ".json", 'w') as f:
+            json.dump({'names': self.names, 't0': self.t0, 'ts': self.ts}, f)
+
+    # records Returns all records (that are not overwritten) in order
+    def records(self):
+        if self.path:
+            self.flush()
+            return np.fromfile(self.path, dtype=record_type)
+        size = len(self.buf)
+        if self.count <= size:
+            return self.buf[:self.count].copy()
+        i = self.count % size
+        return np.concatenate((self.buf[i:], self.buf[:i]))
+
+    # query Returns the records of some nodes (names, default all)
+    # within a window of steps or times (first, last), as a numpy
+    # array with the fields step, time, node (index in names) and value
+    def query(self, nodes=None, steps=None, times=None):
+        r = self.records()
+        if nodes is not None:
+            if type(nodes) == str:
+                nodes = [nodes]
+            k = [self.names.index(name) for name in nodes if name in self.names]
+            r = r[np.isin(r['node'], k)]
+        if steps:
+            r = r[(r['step'] >= steps[0]) & (r['step'] <= steps[1])]
+        if times:
+            r = r[(r['time'] >= times[0]) & (r['time'] <= times[1])]
+        return r
+
+    # series Returns (times, values) of a node
+    def series(self, name, steps=None, times=None):
+        r = self.query(name, steps, times)
+        return r['time'], r['value']
+
+# read_trace Returns a Tracer with the records in a file written by a
+# Tracer with a path, for query() and series()
+def read_trace(path):
+    with open(path + ".json") as f:
+        meta = json.load(f)
+    t = Tracer(size=1)
+    t.path, t.names = path, meta['names']
+    t.t0, t.ts = meta['t0'], meta['ts']
+    t.count = t.written = os.path.getsize(path) // record_type.itemsize
+    return t
+
+# crosses Returns a trigger for Tracer that fires when the value of a
+# node crosses a threshold (in any direction)
+def crosses(name, threshold):
+    last = [None]
+    def trigger(node, value):
+        if node != name or value is None:
+            return False
+        previous, last[0] = last[0], value
+        return previous is not None and \
+            (previous < threshold) != (value < threshold)
+    return trigger
+
 #############################################################################
 # Node is a general class from which all types of nodes will take
 # arguments.  It has a name, a value, an associated function,
@@ -77,6 +469,9 @@ class Node:
         self.rank = None  # Sort order on evaluation (computed in set_rank())
         self.trace = False
         self.save = True
+        # Save the history every save_interval (time), see
+        # System.save_interval. None is as the system
+        self.save_interval = None
         # edge_labels must be a list of strings with the lenght equal
         # to the number of predecessors, which is set by the
         # set_cons() method.  It's only used when generating a system
@@ -126,7 +521,7 @@ class NodeStock(Node):
         super().__init__(name, val=val, detail=detail, unit=unit, cat=cat)
         self.max = max
         self.min = min
-        self.hist = [val]
+        self.hist = History([val])
 
     def eval(self, ts):
         # (to check cons allow nodes without predecessors during development)
@@ -139,7 +534,7 @@ class NodeStock(Node):
         if self.save:
             self.hist.append(self.val)
         if self.trace:
-            print(f'{self.name}: {self.val}')
+            self.trace.record(self, self.val)
 
     def dict(self):
         d = super().dict()
@@ -147,12 +542,12 @@ class NodeStock(Node):
         if self.max != float('inf'): d['max'] = self.max
         if self.min != 0: d['min'] = self.min
         d['val'] = self.val
-        d['hist'] = self.hist
+        d['hist'] = list(self.hist)
         return d
 
     def reset(self):
         self.val = self.hist[0]
-        self.hist = [self.val]
+        self.hist = History([self.val])
 
 #############################################################################
 # NodeFlow is a node which is computed each time.
@@ -162,7 +557,7 @@ class NodeStock(Node):
 class NodeFlow(Node):
     def __init__(self, name, detail=None, unit=None, cat=None):
         super().__init__(name, detail=detail, unit=unit, cat=cat)
-        self.hist = []
+        self.hist = History()
 
     def eval(self, dt):
         if not self.pred:
@@ -173,16 +568,16 @@ class NodeFlow(Node):
         if self.save:
             self.hist.append(self.val)
         if self.trace:
-            print(f'{self.name}: {self.val}')
+            self.trace.record(self, self.val)
 
     def dict(self):
         d = super().dict()
         d['type'] = 'flow'
-        if self.hist: d['hist'] = self.hist
+        if self.hist: d['hist'] = list(self.hist)
         return d
 
     def reset(self):
-        self.hist = []
+        self.hist = History()
 
 #############################################################################
 # NodeDelay3 is a node which is computed each time by using its 2
@@ -197,7 +592,7 @@ class NodeFlow(Node):
 class NodeDelay3(Node):
     def __init__(self, name, val=None, detail=None, unit=None, cat=None):
         super().__init__(name, val=val, detail=detail, unit=unit, cat=cat)
-        self.hist = []
+        self.hist = History()
         self.cst = None
         self.flow = None
         self.I1 = None
@@ -224,7 +619,7 @@ class NodeDelay3(Node):
         if self.save:
             self.hist.append(self.val)
         if self.trace:
-            print(f'{self.name}: {self.val}')
+            self.trace.record(self, self.val)
 
     # This is called from self.cons, so 'flow' and 'constant' are
     # *values* (not nodes)
@@ -237,12 +632,12 @@ class NodeDelay3(Node):
     def dict(self):
         d = super().dict()
         d['type'] = 'delay'
-        if self.hist: d['hist'] = self.hist
+        if self.hist: d['hist'] = list(self.hist)
         return d
 
     def reset(self):
         self.val = None
-        self.hist = []
+        self.hist = History()
         self.I1 = self.I2 = self.I3 = None
         
 #############################################################################
@@ -253,8 +648,16 @@ class NodeDelay3(Node):
 
 class NodeConstant(Node):
     def __init__(self, name, t, val=None, detail=None, unit=None, cat=None):
-        super().__init__(name, val=val, detail=detail, unit=unit, cat=cat)
         self.type = t
+        super().__init__(name, val=val, detail=detail, unit=unit, cat=cat)
+
+    # A table is compiled into a Table when it is set, so a new value
+    # (e.g. from System.update) never leaves a stale lookup behind
+    def __setattr__(self, name, value):
+        if name == 'val' and value is not None and self.type == CT \
+           and type(value) != Table:
+            value = Table(value)
+        super().__setattr__(name, value)
 
     def __repr__(self):
         value = "None"
@@ -275,6 +678,499 @@ class NodeConstant(Node):
         return d
 
 
+#############################################################################
+# StateVector holds the values of all nodes in one contiguous float64
+# array (x). Stocks, flows, delays and constants get an index in x,
+# and the predecessors of a node become an index array. Tables (CT)
+# are not numbers and are passed to the equations as they are.
+#
+# Flows and delays are evaluated in rank order. Stocks are then
+# integrated with one vectorized update, including the min/max
+# clipping. Note that all stock derivatives are computed before the
+# update (standard Euler). The interpreter updates stocks one by one,
+# so the result differs if a stock equation reads *another* stock.
+#
+# Histories are recorded as rows in a 2D array, and are copied to the
+# node histories when the run is done.
+#
+# With batch=N, x has the shape (nodes, N), and N trajectories are
+# computed at once (see System.run_batch()). The equations are called
+# with numpy arrays, except for values that are the same in all
+# trajectories (e.g. time) which are passed as scalars. Equations that
+# can't handle arrays (e.g. an "if" on a value) are detected on the
+# first call, and are then called once per trajectory. Functions in
+# "vectorized" are replaced by their numpy versions.
+#
+# StateVector is meant for batches. Each step still calls every
+# equation in Python, so a single run (engine="vector") is slower than
+# the interpret and compile engines. It is kept for testing the batch
+# path against them.
+#############################################################################
+
+class StateVector:
+    def __init__(self, nodesrank, stocks, batch=None, varying=()):
+        self.batch = batch
+        # Equations simplified by identities (see identity())
+        self.folds = {}
+        for n in nodesrank:
+            fold = identity(n, varying)
+            if fold:
+                self.folds[n] = fold
+        # Nodes that depends on a "varying" node are not uniform
+        self.uniform = set(nodesrank)
+        todo = {p for n in nodesrank for p in list(n.pred) + [n]
+                if p.name in varying}
+        while todo:
+            n = todo.pop()
+            self.uniform.discard(n)
+            todo.update([s for s in n.succ if s in self.uniform])
+        self.index = {}         # node -> index in x
+        self.nodes = []         # nodes with an index
+        def idx(n):
+            if n not in self.index:
+                self.index[n] = len(self.nodes)
+                self.nodes.append(n)
+            return self.index[n]
+        for n in nodesrank:
+            idx(n)
+        self.computed = list(self.nodes)
+        computed = set(self.computed)   # for membership tests
+        for n in nodesrank:
+            self.uniform.update([
+                p for p in n.pred if p not in computed and
+                p.name not in varying])
+        # steps are (kind, node, index, cons, pidx)
+        self.steps = []
+        self.delays = []
+        self.saved = []
+        for n in nodesrank:
+            if type(n) == NodeStock:
+                continue
+            if not n.pred:
+                kind = 'zero' if type(n) == NodeFlow else 'skip'
+                self.steps.append((kind, n, self.index[n], None, None))
+            elif type(n) == NodeFlow:
+                kind = 'flow'
+            elif (type(n) == NodeDelay3 and len(n.pred) == 2
+                  and getattr(n.cons, '__self__', None) is n
+                  and n.cons.__func__ is NodeDelay3.f_delayinit):
+                kind = 'delay'
+                self.delays.append(n)
+            else:
+                if batch:
+                    raise ValueError(f"Can't run node {n.name} in a batch")
+                # Unknown node types are evaluated by n.eval(). The
+                # computed predecessors are written to the nodes first
+                self.steps.append(('node', n, idx(n), None, [
+                    (p, idx(p)) for p in n.pred if p in computed]))
+                continue
+            if n.save and kind != 'skip':
+                self.saved.append(n)
+            if kind in ('flow', 'delay'):
+                cons, pidx = self.bind(n, idx)
+                self.steps.append((kind, n, self.index[n], cons, pidx))
+        self.stocks = [s for s in stocks if s in self.index]
+        self.sidx = np.array(
+            [self.index[s] for s in self.stocks], dtype=np.intp)
+        self.derivs = []
+        for j, s in enumerate(self.stocks):
+            if s.cons:
+                cons, pidx = self.bind(s, idx)
+                self.derivs.append((j, cons, pidx))
+            if s.save:
+                self.saved.append(s)
+        # delay -> column in the zero-delay flags (dsaved)
+        self.dcolumn = {n: k for k, n in enumerate(self.delays)}
+        # Traced nodes are recorded every step, saved or not. Other
+        # node types record themselves in eval()
+        self.traced = [] if batch else [
+            n for n in self.computed if n.trace and (
+                type(n) in (NodeFlow, NodeStock) or n in self.dcolumn)]
+
+    # bind Returns the equation and index array for a node. Tables
+    # (CT) are bound to the equation with a partial function. In
+    # batch runs uniform values (same in all trajectories, e.g. time)
+    # are passed as scalars
+    def bind(self, n, idx):
+        f, pred = self.folds.get(n, (n.cons, n.pred))
+        tables = {
+            i: p for i, p in enumerate(pred)
+            if type(p) == NodeConstant and p.type == CT}
+        pidx = np.array(
+            [idx(p) for i, p in enumerate(pred) if i not in tables],
+            dtype=np.intp)
+        if self.batch:
+            if n not in self.uniform:
+                f = batched(
+                    f.vector if type(f) == Expression
+                    else vectorized.get(f, f))
+            spec = []
+            k = 0
+            for i, p in enumerate(pred):
+                if i in tables:
+                    spec.append(('t', p, None))
+                else:
+                    spec.append(('s' if p in self.uniform else 'r', p, k))
+                    k += 1
+            def cons(*a):
+                return f(*[
+                    p.val if t == 't' else a[k][0] if t == 's' else a[k]
+                    for t, p, k in spec])
+            return cons, pidx
+        if not tables:
+            return f, pidx
+        nargs = len(pred)
+        def cons(*a):
+            it = iter(a)
+            return f(*[
+                tables[i].val if i in tables else next(it)
+                for i in range(nargs)])
+        return cons, pidx
+
+    # load Read node values into a new state vector. None is NaN
+    def load(self):
+        shape = (self.batch,) if self.batch else ()
+        x = np.empty((len(self.nodes),) + shape)
+        for i, n in enumerate(self.nodes):
+            x[i] = np.nan if n.val is None else n.val
+        d = np.empty((len(self.delays), 3) + shape)
+        for k, n in enumerate(self.delays):
+            for j, I in enumerate((n.I1, n.I2, n.I3)):
+                d[k, j] = np.nan if I is None else I
+        return x, d
+
+    # integrate Runs nb_step steps. "record" is a list of [k, offset,
+    # hidx, hist, row]. The values of the nodes in hidx are recorded in
+    # hist (one row per record) every k-th step, counted from init
+    # time with "first" as the first step (see Sampler). Nodes that
+    # evaluate themselves save their history every "every"[n] step
+    def integrate(self, x, d, nb_step, ts, record, first=0, every={}):
+        smax = np.array([s.max for s in self.stocks], dtype=float)
+        smin = np.array([s.min for s in self.stocks], dtype=float)
+        derivs = np.zeros(x[self.sidx].shape)
+        if self.batch:
+            smax, smin = smax[:, None], smin[:, None]
+        # zero-delays are not saved (as in NodeDelay3.eval())
+        dsaved = np.ones((nb_step, len(self.delays)), dtype=bool)
+        flow = [n.flow for n in self.delays]
+        cst = [n.cst for n in self.delays]
+        for step in range(nb_step):
+            k = 0
+            for kind, n, i, cons, pidx in self.steps:
+                match kind:
+                    case 'flow':
+                        x[i] = cons(*x[pidx])
+                    case 'delay':
+                        flow[k], cst[k] = u, c = x[pidx]
+                        new = np.isnan(d[k, 0])
+                        if new.any():
+                            d[k] = np.where(new, u * c / 3, d[k])
+                        zero = c == 0
+                        dl = np.where(zero, 3, c) / 3
+                        I1, I2, I3 = d[k]
+                        RT1 = I1 / dl
+                        I1 = I1 + (u - RT1) * ts
+                        RT2 = I2 / dl
+                        I2 = I2 + (RT1 - RT2) * ts
+                        I3 = I3 + (RT2 - I3 / dl) * ts
+                        d[k] = np.where(zero, d[k], (I1, I2, I3))
+                        x[i] = np.where(zero, u, I3 / dl)
+                        dsaved[step, k] = not np.all(zero)
+                        k += 1
+                    case 'zero':
+                        x[i] = 0
+                    case 'node':
+                        for p, j in pidx:
+                            p.val = x[j].item()
+                        if every.get(n, 1) > 1:
+                            n.save = (first + step) % every[n] == 0
+                        n.eval(ts)
+                        x[i] = n.val
+            for j, cons, pidx in self.derivs:
+                derivs[j] = cons(*x[pidx])
+            x[self.sidx] = np.maximum(
+                np.minimum(x[self.sidx] + derivs * ts, smax), smin)
+            for r in record:
+                k, offset, hidx, hist, row = r
+                if (first + step + offset) % k == 0:
+                    hist[row] = x[hidx]
+                    r[4] = row + 1
+            for n in self.traced:
+                if n in self.dcolumn and not dsaved[step, self.dcolumn[n]]:
+                    continue    # zero-delay, as in NodeDelay3.eval()
+                n.trace.record(n, x[self.index[n]].item(), first + step)
+        return flow, cst, dsaved
+
+    # run Runs nb_step steps. Nodes in "every" {node: k} save their
+    # history every k-th step (see System.save_every())
+    def run(self, nb_step, ts, every={}, first=0):
+        x, d = self.load()
+        groups = {}
+        for n in self.saved:
+            offset = 1 if type(n) == NodeStock else 0
+            groups.setdefault((every.get(n, 1), offset), []).append(n)
+        record = []
+        for (k, offset), nodes in groups.items():
+            hidx = np.array([self.index[n] for n in nodes], dtype=np.intp)
+            rows = len(range((-first - offset) % k, nb_step, k))
+            record.append([k, offset, hidx, np.empty((rows, len(hidx))), 0])
+        flow, cst, dsaved = self.integrate(
+            x, d, nb_step, ts, record, first, every)
+        for kind, n, i, cons, pidx in self.steps:
+            if kind == 'node' and n in every:
+                n.save = True
+        self.store(x, d, flow, cst, dsaved)
+        for (k, offset), nodes in groups.items():
+            self.extend(nodes, record.pop(0)[3], dsaved[
+                (-first - offset) % k::k])
+
+    # store Write values back to the nodes. NaN is None
+    def store(self, x, d, flow, cst, dsaved):
+        for n in self.computed:
+            v = x[self.index[n]].item()
+            n.val = None if v != v else v
+        for k, n in enumerate(self.delays):
+            if not np.isnan(d[k, 0]):
+                n.I1, n.I2, n.I3 = d[k].tolist()
+                n.flow, n.cst = float(flow[k]), float(cst[k])
+
+    # extend Extends the histories of nodes with the columns of hist.
+    # dsaved are the rows of zero-delay flags for the same steps
+    def extend(self, nodes, hist, dsaved):
+        for j, n in enumerate(nodes):
+            h = hist[:, j]
+            if n in self.dcolumn:
+                h = h[dsaved[:, self.dcolumn[n]]]
+            n.hist.extend(h)
+
+    # run_batch Runs N trajectories. params is a dict {name: values}
+    # with N values for constants (C) or initial values of stocks.
+    # The nodes are not updated, instead a dict {name: array(N,
+    # nb_step)} with the histories of the "outputs" nodes is returned
+    def run_batch(self, nb_step, ts, params, outputs):
+        x, d = self.load()
+        for name, values in params.items():
+            n = [n for n in self.nodes if n.name == name]
+            if n:
+                x[self.index[n[0]]] = values
+        hnodes = [n for n in self.saved if n.name in outputs]
+        hidx = np.array([self.index[n] for n in hnodes], dtype=np.intp)
+        x0 = x[hidx]
+        hist = np.empty((nb_step,) + x0.shape)
+        flow, cst, dsaved = self.integrate(
+            x, d, nb_step, ts, [[1, 0, hidx, hist, 0]])
+        result = {}
+        for j, n in enumerate(hnodes):
+            h = hist[:, j]
+            if type(n) == NodeStock:
+                # stocks have the initial value first
+                h = np.concatenate((x0[j:j+1], h[:-1]))
+            elif n in self.dcolumn:
+                # as in extend(), steps where the delay was zero for
+                # all trajectories are not saved
+                h = h[dsaved[:, self.dcolumn[n]]]
+            result[n.name] = h.T.copy()
+        return result
+
+# link Returns the run function of code from System.compile() for
+# the nodes. Node k is "n{k}" and its equation "f{k}"
+def link(code, nodes):
+    ns = {'nan': math.nan}
+    for k, n in enumerate(nodes):
+        ns[f'n{k}'] = n
+        ns[f'f{k}'] = n.cons.scalar if type(n.cons) == Expression \
+            else n.cons
+        if n.cons in identities:
+            ns[f'g{k}'] = identities[n.cons][2]
+    exec(code, ns)
+    return ns['run']
+
+# batched Wraps an equation for batch runs. If the equation fails
+# with arrays it is called once per trajectory instead
+def batched(f):
+    vector = True
+    def g(*a):
+        nonlocal vector
+        if vector:
+            try:
+                return f(*a)
+            except (TypeError, ValueError):
+                vector = False
+        N = max([len(v) for v in a if type(v) == np.ndarray])
+        return [
+            f(*[v[j] if type(v) == np.ndarray else v for v in a])
+            for j in range(N)]
+    return g
+
+#############################################################################
+# RungeKutta integrates the model with a Runge-Kutta method instead
+# of Euler. The state (y) is the value of all stocks followed by
+# I1, I2, I3 of all delays, so a delay is integrated as three
+# stocks. f(y) sets the state in the nodes, evaluates flows and
+# delays in rank order and returns the derivatives. Stocks are
+# clipped to min/max in every evaluation and after every step.
+#
+# "rk4" is the classic fourth order method with a fixed step (TS).
+# "rk45" is Dormand-Prince 5(4). It takes as many internal steps as
+# needed to keep the estimated error below atol + rtol*|y| and
+# stops at each TS, so TS is the output interval.
+#
+# Histories are kept as for Euler, flows and delays are saved with
+# the values at the start of a step, stocks after it. Unlike Euler
+# the delays are saved with the value at the start of the step too.
+#############################################################################
+
+# Butcher tableaus (a, b) and the error weights for rk45
+RK4 = ([[1/2], [0, 1/2], [0, 0, 1]], [1/6, 1/3, 1/3, 1/6])
+DOPRI = (
+    [[1/5],
+     [3/40, 9/40],
+     [44/45, -56/15, 32/9],
+     [19372/6561, -25360/2187, 64448/6561, -212/729],
+     [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+DOPRI_E = [
+    71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+
+class RungeKutta:
+    def __init__(self, nodesrank, stocks, rtol=1e-6, atol=1e-6):
+        self.stocks = stocks
+        self.nodes = [n for n in nodesrank if n not in stocks]
+        for n in self.nodes:
+            if type(n) != NodeFlow and type(n) != NodeDelay3:
+                raise ValueError(f"Can't integrate {n.name} with Runge-Kutta")
+        self.delays = [n for n in self.nodes if type(n) == NodeDelay3 and n.pred]
+        ns = len(stocks)
+        self.index = {d: ns + 3*k for k, d in enumerate(self.delays)}
+        self.size = ns + 3 * len(self.delays)
+        self.smax = np.array([float(s.max) for s in stocks])
+        self.smin = np.array([float(s.min) for s in stocks])
+        self.rtol, self.atol = rtol, atol
+        self.h = None           # last step size (rk45)
+
+    # state Returns y from the nodes. Delays that are not initiated
+    # yet are NaN, they are initiated in the first f()
+    def state(self):
+        y = np.full(self.size, np.nan)
+        y[:len(self.stocks)] = [s.val for s in self.stocks]
+        for d, j in self.index.items():
+            if d.I1 is not None:
+                y[j:j+3] = (d.I1, d.I2, d.I3)
+        return y
+
+    # set Clips the stocks and sets the state in the nodes
+    def set(self, y):
+        ns = len(self.stocks)
+        np.clip(y[:ns], self.smin, self.smax, out=y[:ns])
+        for s, v in zip(self.stocks, y[:ns].tolist()):
+            s.val = v
+        for d, j in self.index.items():
+            if y[j] == y[j]:
+                d.I1, d.I2, d.I3 = y[j:j+3].tolist()
+
+    # f Sets the state and returns the derivatives. If save is True
+    # the flows and delays are appended to their histories
+    def f(self, y, save=False):
+        ns = len(self.stocks)
+        np.clip(y[:ns], self.smin, self.smax, out=y[:ns])
+        for s, v in zip(self.stocks, y[:ns].tolist()):
+            s.val = v
+        dy = [0.0] * self.size
+        for n in self.nodes:
+            if type(n) == NodeFlow:
+                n.val = n.cons(*[p.val for p in n.pred]) if n.pred else 0
+            elif n.pred:
+                j = self.index[n]
+                if y[j] != y[j]:
+                    n.I1 = None     # initiated by f_delayinit
+                else:
+                    n.I1, n.I2, n.I3 = y[j:j+3].tolist()
+                n.cons(*[p.val for p in n.pred])
+                y[j:j+3] = (n.I1, n.I2, n.I3)
+                if n.cst == 0:
+                    n.val = n.flow
+                    continue
+                dl = n.cst / 3
+                RT1 = n.I1 / dl
+                RT2 = n.I2 / dl
+                n.val = n.I3 / dl
+                dy[j] = n.flow - RT1
+                dy[j+1] = RT1 - RT2
+                dy[j+2] = RT2 - n.val
+            else:
+                continue        # orphan delay
+            if save:
+                if n.save:
+                    n.hist.append(n.val)
+                if n.trace:
+                    n.trace.record(n, n.val)
+        for k, s in enumerate(self.stocks):
+            if s.cons:
+                dy[k] = s.cons(*[p.val for p in s.pred])
+        return np.array(dy)
+
+    # stages Appends the derivatives of the stages after k1 to k, and
+    # returns the state given by the weights b
+    def stages(self, y, h, k, a, b):
+        for row in a:
+            k.append(self.f(y + h * sum([c * ki for c, ki in zip(row, k) if c])))
+        return y + h * sum([c * ki for c, ki in zip(b, k) if c])
+
+    def rk4(self, y, ts):
+        return self.stages(y, ts, [self.f(y, True)], *RK4)
+
+    def rk45(self, y, ts):
+        k1 = self.f(y, True)
+        t = 0.0
+        h = self.h if self.h else ts
+        while True:
+            last = t + h >= ts
+            if last:
+                h = ts - t
+            k = [k1]
+            y5 = self.stages(y, h, k, *DOPRI)
+            k.append(self.f(y5))    # k1 of the next step (FSAL)
+            err = h * sum([c * ki for c, ki in zip(DOPRI_E, k) if c])
+            scale = self.atol + self.rtol * np.maximum(abs(y), abs(y5))
+            en = math.sqrt(np.mean((err / scale) ** 2))
+            factor = min(5, max(0.2, 0.9 * en ** -0.2)) if en > 0 else 5
+            if en <= 1:
+                y, k1, t = y5, k[-1], t + h
+                if not last:
+                    self.h = h * factor
+                if last:
+                    return y
+            else:
+                if h < ts * 1e-12:
+                    raise ArithmeticError(f"Step size underflow at {t}")
+                self.h = h * factor
+            h = self.h
+
+    # run Runs nb_step steps. A Sampler switches saving on and off.
+    # "first" is the step where the run starts (for tracers)
+    def run(self, nb_step, ts, method, sampler=None, first=0):
+        match method:
+            case "rk4":
+                step = self.rk4
+            case "rk45":
+                step = self.rk45
+            case _:
+                raise ValueError(f"Unknown method: {method}")
+        y = self.state()
+        tracers = {n.trace for n in self.nodes + self.stocks if n.trace}
+        for i in range(nb_step):
+            if sampler:
+                sampler.step(i)
+            for t in tracers:
+                t.step = first + i
+            y = step(y, ts)
+            self.set(y)
+            for s in self.stocks:
+                if s.save:
+                    s.hist.append(s.val)
+                if s.trace:
+                    s.trace.record(s, s.val)
+
 #############################################################################
 # System Was originally the World3 class. It was modified to allow usage
 # as a generic SD class
@@ -295,6 +1191,27 @@ class System:
         self.time_unit=time_unit
         self.end_time = end_time
         self.default_cat = None
+        # "interpret" evaluates node by node (the reference), "compile"
+        # uses a generated step function, see compile(). "vector" (a
+        # StateVector) is the backend of run_batch(). It gives the same
+        # result, but a single run is slower than with the others
+        self.engine = "interpret"
+        # Integration method, "euler", "rk4" or "rk45" (see
+        # RungeKutta). The Runge-Kutta methods evaluate node by node
+        # regardless of the engine. rtol/atol are used by "rk45"
+        self.method = "euler"
+        self.rtol = 1e-6
+        self.atol = 1e-6
+        self.steps = 0  # steps taken since init time, see run()
+        # Save histories every save_interval (time) instead of every
+        # time step (as SAVEPER in Vensim). It is rounded to a number
+        # of steps. Nodes may override it (Node.save_interval)
+        self.save_interval = None
+        self.pruned = 0 # nodes not evaluated in the last run()
+        # Compute flows that only depend on constants once per run()
+        # instead of every step, see fold()
+        self.fold_constants = True
+        self.tracer = None  # the default Tracer, see trace()
 
     def __repr__(self):
         return "\n".join([str(v) for c,v in self.nodes.items()])
@@ -305,6 +1222,7 @@ class System:
             print(self.nodes[node.name])
             raise NodeAlreadyExistsError()
         self.nodes[node.name] = node
+        self.modified()
 
     def addStock(
             self, name, val=0, detail=None, unit=None, cat=None,
@@ -334,23 +1252,514 @@ class System:
         self.add_node(c)
         return c
 
-    def add_equation(self, f, x_target, x_s, edge_labels=None):
+    # add_equation Sets the equation of a node. "f" is a function of
+    # the predecessors x_s, or an expression (see Expression), e.g.
+    # add_equation("ic*(1-fcaor)*cuf/icor", io). Then the predecessors
+    # are the nodes in the expression, unless x_s is given
+    def add_equation(self, f, x_target, x_s=None, edge_labels=None):
+        if type(f) == str:
+            f = Expression(f, self.nodes, x_s)
+            x_s = [self.nodes[name] for name in f.args]
         x_target.set_cons(f, x_s, edge_labels)
+        self.modified()
 
-    def eval(self, ts):
-        for ns in self.nodesrank:
+    # modified Drops the cached ranking and compiled engines. Called
+    # when nodes or equations are added
+    def modified(self):
+        self.nodesrank = None
+        self.compiled = {}
+
+    def eval(self, ts, rank=None):
+        for ns in rank if rank else self.nodesrank:
             ns.eval(ts)
 
-    def run(self, end_time=None):
+    # run Runs the model from where it is to the end time. With
+    # "until" the run stops at that time, and a later run() continues
+    # from there. Steps are counted from init time, so run(until=2002)
+    # followed by run() gives the same result as one run(). With
+    # "outputs" (node names) only the nodes needed to compute them are
+    # evaluated (see prune()), and the number of nodes that are not is
+    # set in self.pruned. The other nodes keep their values and
+    # histories, so a continued run must use the same outputs. With
+    # "profile" (a Profile) the nodes are evaluated one by one and timed
+    def run(
+            self, end_time=None, engine=None, method=None, until=None,
+            outputs=None, profile=None):
         self.set_rank()
+        rank = self.prune(outputs) if outputs else self.nodesrank
+        self.pruned = len(self.nodesrank) - len(rank)
+        stocks = [n for n in rank if type(n) == NodeStock]
+        it = self.nodes['time'].hist[0]
+        et = until if until else end_time if end_time else self.end_time
+        ts = self.nodes['TS'].val
+        nb_step = int((et - it) / ts) - self.steps
+        if nb_step <= 0:
+            return
+        every = self.save_every(rank)
+        if self.steps > 0:
+            # Continue. Put back the stock values removed below
+            for stock in stocks:
+                if self.steps % every.get(stock, 1) == 0:
+                    stock.hist.append(stock.val)
+        engine = engine if engine else self.engine
+        method = method if method else self.method
+        # Preallocate histories for the run
+        for n in rank:
+            if n.save and hasattr(n, 'hist'):
+                if type(n.hist) != History:
+                    n.hist = History(n.hist)
+                n.hist.reserve(nb_step // every.get(n, 1) + 1)
+        folded = self.fold(rank) if self.fold_constants else []
+        if folded:
+            for n in folded:
+                n.val = n.cons(*[p.val for p in n.pred]) if n.pred else 0
+                if n.save:
+                    k = every.get(n, 1)
+                    n.hist.extend(
+                        [n.val] * len(range((-self.steps) % k, nb_step, k)))
+            folded = set(folded)
+            rank = [n for n in rank if n not in folded]
+        if method != "euler":
+            engine = "runge-kutta"
+        if profile is not None:
+            if method != "euler":
+                raise ValueError(f"Can't profile the {method} method")
+            engine = "profile"
+        sampler = Sampler(every, self.steps) if every else None
+        tracers = {n.trace for n in rank if n.trace}
+        for t in tracers:
+            t.start(it, ts)
+        # The save flags and traces are restored and flushed also when
+        # an equation raises
+        try:
+            match engine:
+                case "runge-kutta":
+                    RungeKutta(
+                        rank, stocks, self.rtol, self.atol
+                    ).run(nb_step, ts, method, sampler, self.steps)
+                case "interpret":
+                    for i in range(nb_step):
+                        if sampler:
+                            sampler.step(i)
+                        for t in tracers:
+                            t.step = self.steps + i
+                        self.eval(ts, rank)
+                case "profile":
+                    profile.start(rank)
+                    try:
+                        for i in range(nb_step):
+                            if sampler:
+                                sampler.step(i)
+                            for t in tracers:
+                                t.step = self.steps + i
+                            profile.eval(rank, ts)
+                    finally:
+                        profile.stop()
+                case "compile":
+                    self.compile(rank)(nb_step, ts, self.steps)
+                case "vector":
+                    self.vectorize(rank).run(nb_step, ts, every, self.steps)
+                case _:
+                    raise ValueError(f"Unknown engine: {engine}")
+        finally:
+            if sampler:
+                sampler.done()
+            for t in tracers:
+                t.flush()
+        self.steps += nb_step
+        for stock in stocks:
+            # (since stocks have an init-val)
+            if self.steps % every.get(stock, 1) == 0:
+                stock.hist.pop()
+
+    # iter_run Runs the model as run(), but yields a record {name:
+    # value} with 'time' and the "nodes" (default all nodes with
+    # history) for every saved step, i.e. every time step or every
+    # save_interval. The model is run "chunk" saved steps at the time
+    # with run(until=...), and only the nodes needed are evaluated (see
+    # prune()). Between the chunks the model is in the same state as
+    # after run(until=...), so the consumer can stop at any record
+    # (the model is at most a chunk ahead), or hold the generator and
+    # continue later. With history=False the histories are truncated
+    # after each chunk, so any number of steps can be run in constant
+    # memory (but the histories are then not complete). Example:
+    #
+    #   for r in s.iter_run(['pop', 'nr']):
+    #       if r['pop'] < 7e9:
+    #           break
+    def iter_run(self, nodes=None, end_time=None, chunk=1, history=True):
+        self.set_rank()
+        names = ['time'] + [n for n in (nodes or []) if n != 'time']
+        if not nodes:
+            names += [n.name for n in self.nodesrank
+                      if n.save and n.name != 'time']
+        it = self.nodes['time'].hist[0]
+        ts = self.nodes['TS'].val
+        et = end_time if end_time else self.end_time
+        nb_step = int((et - it) / ts)
+        k = max(1, round(self.save_interval / ts)) \
+            if self.save_interval else 1
+        hists = [n for n in self.nodesrank if hasattr(n, 'hist')]
+        keep = [len(n.hist) for n in hists]
+        while self.steps < nb_step:
+            saved = -(-self.steps // k)
+            steps = min(nb_step, (self.steps // k + chunk) * k)
+            # Half a step more, so rounding doesn't lose a step
+            self.run(until=it + (steps + 0.5) * ts, outputs=nodes)
+            # The new values are the last in the histories
+            count = -(-self.steps // k) - saved
+            values = [self.nodes[n].hist for n in names]
+            records = [
+                {n: h[j - count] if count - j <= len(h) else None
+                 for n, h in zip(names, values)}
+                for j in range(count)]
+            if not history:
+                for n, length in zip(hists, keep):
+                    n.hist.n = min(n.hist.n, length)
+            yield from records
+
+    # save_every Returns {node: k} for the nodes in rank that save
+    # their history every k-th step (k > 1), see save_interval
+    def save_every(self, rank):
+        ts = self.nodes['TS'].val
+        every = {}
+        for n in rank:
+            interval = n.save_interval or self.save_interval
+            if n.save and interval:
+                k = max(1, round(interval / ts))
+                if k > 1:
+                    every[n] = k
+        return every
+
+    # times Returns the times of the history of a node, which differs
+    # from the time stock if the node has its own save_interval
+    def times(self, name):
+        n = self.nodes[name]
+        interval = n.save_interval or self.save_interval
+        ts = self.nodes['TS'].val
+        k = max(1, round(interval / ts)) if interval else 1
+        it = self.nodes['time'].hist[0]
+        return [it + j * k * ts for j in range(len(n.hist))]
+
+    # prune Returns the ranked nodes needed to compute the "outputs"
+    # nodes; those reached by following the predecessors backwards,
+    # which includes the stocks (and their flows) that feed back into
+    # them. The time stock is always needed. Cached per outputs until
+    # the model is modified
+    def prune(self, outputs):
+        self.set_rank()
+        key = ("prune", tuple(outputs))
+        if key in self.compiled:
+            return self.compiled[key]
+        needed = set()
+        todo = [self.nodes[name] for name in list(outputs) + ['time']]
+        while todo:
+            n = todo.pop()
+            if n not in needed:
+                needed.add(n)
+                todo.extend(n.pred)
+        rank = [n for n in self.nodesrank if n in needed]
+        self.compiled[key] = rank
+        return rank
+
+    # fold Returns the flows in rank that only depend on constants, or
+    # on other such flows. They have the same value in every step, so
+    # run() computes them once and leaves them out of the rank given
+    # to the engines. Traced flows are not folded. Cached as prune()
+    def fold(self, rank):
+        key = ("fold",) + tuple([n.name for n in rank])
+        if key in self.compiled:
+            return self.compiled[key]
+        folded = []
+        for n in rank:
+            if type(n) == NodeFlow and not n.trace and all([
+                    type(p) == NodeConstant or p in folded for p in n.pred]):
+                folded.append(n)
+        self.compiled[key] = folded
+        return folded
+
+    # snapshot Returns the state of the system; the values of all
+    # nodes, the internals of delays, and copies of the histories.
+    # restore() sets the system back to the snapshot, which can be
+    # done any number of times. Use it to run the common part of
+    # some scenarios once, e.g:
+    #
+    #   s.run(until=2002)
+    #   snap = s.snapshot()
+    #   for c in constants:
+    #       s.restore(snap)
+    #       s.nodes['NRI'].val = c
+    #       s.run()
+    #
+    # Constants are included, so restore() also undoes changes of them
+    def snapshot(self):
+        nodes = {}
+        for name, n in self.nodes.items():
+            state = {'val': n.val}
+            if type(n) == NodeDelay3:
+                for a in ('I1', 'I2', 'I3', 'flow', 'cst'):
+                    state[a] = getattr(n, a)
+            if hasattr(n, 'hist'):
+                state['hist'] = History(n.hist) \
+                    if type(n.hist) != History else n.hist.copy()
+            nodes[name] = state
+        return {'steps': self.steps, 'nodes': nodes}
+
+    def restore(self, snapshot):
+        self.steps = snapshot['steps']
+        for name, state in snapshot['nodes'].items():
+            n = self.nodes[name]
+            for a, v in state.items():
+                setattr(n, a, v.copy() if a == 'hist' else v)
+
+    #########################################################################
+    # compile: generate a function that runs nb_step steps of the
+    # ranked nodes (self.nodesrank). It does exactly what eval() does,
+    # in the same order and with the same arithmetic, so the result is
+    # identical to the interpreted run. But node values are kept in
+    # local variables (v0, v1, ...) and equations (f0, f1, ...) are
+    # called directly. Values are loaded from the nodes when the
+    # function is called, and written back when it returns. Node
+    # types unknown to the compiler are evaluated with their own
+    # eval() method.  The function is cached until the model is
+    # modified (add_node, add_equation, trace, history). With "rank"
+    # (see prune()) only those nodes are run. Equations where an
+    # identity applies (see identities) call the simpler function
+    #########################################################################
+
+    def compile(self, rank=None):
+        if rank is None or rank == self.nodesrank:
+            rank, key = self.nodesrank, "compile"
+        else:
+            key = ("compile",) + tuple([n.name for n in rank])
+        every = self.save_every(rank)
+        # Equations simplified by identities depend on constant values
+        folds = {n: identity(n) for n in rank if identity(n)}
+        cached, run, code, nodes, saving, folded = self.compiled.get(
+            key, (None, None, None, None, None, None))
+        if cached == rank and saving == every and folded == set(folds):
+            return run
+        slot = {}
+        def var(n):
+            if n not in slot:
+                slot[n] = len(slot)
+            return f'v{slot[n]}'
+        computed = set(rank)
+        init, loop, done = [], [], []
+        # Histories are written by index (i) into the preallocated
+        # History buffer (hb). Delays that may skip a step, and nodes
+        # saved every k-th step (see Sampler), use a counter. The
+        # latter are saved when the flag p{k}_{offset} is set. Only
+        # the history append is gated by the flag; tracers and
+        # everything emitted after it run every step
+        flags = set()
+        def emit_save(n, k, indent):
+            if n.trace:
+                loop.append(f'{indent}n{k}.trace.record(n{k}, v{k}, first + i)')
+            if n.save:
+                init.append(f'h{k} = n{k}.hist')
+                init.append(f'hb{k}, ho{k} = h{k}.buf, h{k}.n')
+                e = every.get(n, 1)
+                if e > 1 or type(n) == NodeDelay3:
+                    # The gated block is only the history append
+                    gated = indent
+                    if e > 1:
+                        offset = 1 if type(n) == NodeStock else 0
+                        flags.add((e, offset))
+                        loop.append(f'{indent}if p{e}_{offset}:')
+                        gated = indent + '    '
+                    if type(n) == NodeFlow:
+                        loop.append(f'{gated}try:')
+                        loop.append(f'{gated}    hb{k}[ho{k}] = v{k}')
+                        loop.append(f'{gated}except TypeError:')
+                        loop.append(f'{gated}    hb{k}[ho{k}] = nan if v{k} is None else v{k}')
+                    else:
+                        loop.append(f'{gated}hb{k}[ho{k}] = v{k}')
+                    loop.append(f'{gated}ho{k} += 1')
+                    done.append(f'h{k}.n = ho{k}')
+                elif type(n) == NodeFlow:
+                    # flows may be None
+                    loop.append(f'{indent}try:')
+                    loop.append(f'{indent}    hb{k}[ho{k} + i] = v{k}')
+                    loop.append(f'{indent}except TypeError:')
+                    loop.append(f'{indent}    hb{k}[ho{k} + i] = nan if v{k} is None else v{k}')
+                    done.append(f'h{k}.n = ho{k} + nb_step')
+                else:
+                    loop.append(f'{indent}hb{k}[ho{k} + i] = v{k}')
+                    done.append(f'h{k}.n = ho{k} + nb_step')
+        for n in rank:
+            v = var(n)
+            k = slot[n]
+            args = ", ".join([var(p) for p in n.pred])
+            if n in folds:
+                # g{k} is set by link()
+                args = ", ".join([var(p) for p in folds[n][1]])
+            f = f'g{k}' if n in folds else f'f{k}'
+            if type(n) == NodeFlow:
+                if not n.pred:
+                    loop.append(f'    {v} = 0')
+                else:
+                    loop.append(f'    {v} = {f}({args})')
+                emit_save(n, k, '    ')
+            elif type(n) == NodeStock:
+                init.append(f'x{k} = n{k}.max')
+                init.append(f'm{k} = n{k}.min')
+                if n.cons:
+                    loop.append(f'    {v} = {v} + {f}({args}) * ts')
+                loop.append(f'    if {v} > x{k}: {v} = x{k}')
+                loop.append(f'    if {v} < m{k}: {v} = m{k}')
+                emit_save(n, k, '    ')
+            elif (type(n) == NodeDelay3 and len(n.pred) == 2
+                  and getattr(n.cons, '__self__', None) is n
+                  and n.cons.__func__ is NodeDelay3.f_delayinit):
+                # Inlined f_delayinit() and NodeDelay3.eval()
+                flow, cst = [var(p) for p in n.pred]
+                init.append(f'a{k}, b{k}, c{k} = n{k}.I1, n{k}.I2, n{k}.I3')
+                init.append(f'u{k}, d{k} = n{k}.flow, n{k}.cst')
+                loop.append(f'    u{k} = {flow}')
+                loop.append(f'    d{k} = {cst}')
+                loop.append(f'    if a{k} == None:')
+                loop.append(f'        a{k} = b{k} = c{k} = u{k} * d{k} / 3')
+                loop.append(f'    if d{k} == 0:')
+                loop.append(f'        {v} = u{k}')
+                loop.append('    else:')
+                loop.append(f'        dl = d{k} / 3')
+                loop.append(f'        RT1 = a{k} / dl')
+                loop.append(f'        a{k} = a{k} + (u{k} - RT1) * ts')
+                loop.append(f'        RT2 = b{k} / dl')
+                loop.append(f'        b{k} = b{k} + (RT1 - RT2) * ts')
+                loop.append(f'        c{k} = c{k} + (RT2 - c{k} / dl) * ts')
+                loop.append(f'        {v} = c{k} / dl')
+                emit_save(n, k, '        ')
+                done.append(f'n{k}.I1, n{k}.I2, n{k}.I3 = a{k}, b{k}, c{k}')
+                done.append(f'n{k}.flow, n{k}.cst = u{k}, d{k}')
+            else:
+                # Let the node evaluate itself
+                for p in n.pred:
+                    if p in computed:
+                        loop.append(f'    n{slot[p]}.val = {var(p)}')
+                e = every.get(n, 1)
+                if e > 1:
+                    # eval() saves the history, as with a Sampler
+                    flags.add((e, 0))
+                    loop.append(f'    n{k}.save = p{e}_0')
+                    done.append(f'n{k}.save = True')
+                loop.append(f'    n{k}.eval(ts)')
+                loop.append(f'    {v} = n{k}.val')
+            done.append(f'n{k}.val = {v}')
+        init = [f'v{k} = n{k}.val' for k in range(len(slot))] + init
+        loop = [f'    p{e}_{o} = (first + i + {o}) % {e} == 0'
+                for e, o in sorted(flags)] + loop
+        src = ["def run(nb_step, ts, first=0):"]
+        src += ['    ' + line for line in init]
+        src += ['    for i in range(nb_step):']
+        src += ['    ' + line for line in loop]
+        src += ['    ' + line for line in done]
+        code = compile("\n".join(src), "<System.compile>", "exec")
+        nodes = list(slot)
+        run = link(code, nodes)
+        self.compiled[key] = (rank, run, code, nodes, every, set(folds))
+        return run
+
+    # clone Returns a copy of the system with fresh state and
+    # history, as after reset(). The nodes are copied and linked to
+    # each other, but equations, tables and other values are shared,
+    # and the ranking and compiled code are reused. This is much
+    # faster than building the model again
+    def clone(self):
+        s = copy.copy(self)
+        copies = {}
+        for old in self.nodes.values():
+            n = copies[old] = object.__new__(type(old))
+            n.__dict__.update(old.__dict__)
+        for old, n in copies.items():
+            n.pred = type(old.pred)([copies[p] for p in old.pred])
+            n.succ = {copies[p] for p in old.succ}
+            if getattr(n.cons, '__self__', None) is old:
+                # e.g. f_delayinit() of a delay
+                n.cons = types.MethodType(n.cons.__func__, n)
+            n.reset()
+        s.nodes = {name: copies[n] for name, n in self.nodes.items()}
+        s.stocks = [copies[n] for n in self.stocks]
+        s.compiled = {}
+        s.steps = 0
+        if self.nodesrank is None:
+            return s
+        s.nodesrank = [copies[n] for n in self.nodesrank]
+        for key, value in self.compiled.items():
+            if key[0] in ("prune", "fold"):
+                s.compiled[key] = [copies[n] for n in value]
+            elif key == "compile" or key[0] == "compile":
+                rank, run, code, nodes, every, folded = value
+                nodes = [copies[n] for n in nodes]
+                s.compiled[key] = (
+                    [copies[n] for n in rank], link(code, nodes), code,
+                    nodes, {copies[n]: k for n, k in every.items()},
+                    {copies[n] for n in folded})
+        return s
+
+    def run_batch(self, params, end_time=None, outputs=None):
+        """Run N trajectories at once.
+
+        Parameters
+        ----------
+        params: dict
+            {name: values} where values are N values for a constant
+            (C), or N initial values for a stock. Example:
+            {'NRI': v, 'nr': v}
+        end_time: optional
+            As for run()
+        outputs: list of str, optional
+            Nodes to return. Default all nodes with history save.
+            Only the nodes needed for them are evaluated (see prune())
+        Returns
+        -------
+        dict {name: numpy.array(N, nb_step)} with the histories. The
+        System itself is not modified.
+
+        Batches are integrated with Euler only. A ValueError is
+        raised if s.method is another method, rather than giving
+        results that differ from run().
+        """
+        if self.method != "euler":
+            raise ValueError(
+                f"Can't run a batch with the {self.method} method")
+        self.set_rank()
+        N = None
+        for name, values in params.items():
+            n = self.nodes[name]
+            if not (type(n) == NodeStock or
+                    (type(n) == NodeConstant and n.type == C)):
+                raise ValueError(f"Can't batch {name}")
+            if N and len(values) != N:
+                raise ValueError(f"Length of {name} must be {N}")
+            N = len(values)
         it = self.nodes['time'].hist[0]
         et = end_time if end_time else self.end_time
         ts = self.nodes['TS'].val
         nb_step = int((et - it) / ts)
-        for i in range(nb_step):
-            self.eval(ts)
-        for stock in self.stocks:
-            stock.hist.pop() # (since stocks have an init-val)
+        rank = self.nodesrank
+        if outputs is None:
+            outputs = self.nodes.keys()
+        else:
+            rank = self.prune(outputs)
+        sv = StateVector(rank, self.stocks, batch=N, varying=params.keys())
+        return sv.run_batch(nb_step, ts, params, outputs)
+
+    # vectorize Returns the StateVector of the ranked nodes (or
+    # "rank"). It is cached the same way as compile()
+    def vectorize(self, rank=None):
+        if rank is None or rank == self.nodesrank:
+            rank, key = self.nodesrank, "vector"
+        else:
+            key = ("vector",) + tuple([n.name for n in rank])
+        cached, sv = self.compiled.get(key, (None, None))
+        if cached == rank and list(sv.folds) == [
+                n for n in rank if identity(n)]:
+            return sv
+        sv = StateVector(rank, self.stocks)
+        self.compiled[key] = (rank, sv)
+        return sv
 
     #########################################################################
     # sub_graph_vertex: allow to obtain sub-graphs from known values
@@ -377,37 +1786,90 @@ class System:
 
     #########################################################################
     # set_rank: allow to have the order to follow to solve the graph
-    # dM: list of the number of predecessors for each node S0: list
-    # of order to evaluate nodes which have no predecessors
-    # rank_rec: build the list of order r by recurrence using the
-    # first solution S0 nodesrank: list of nodes ordered by priority
-    # in the calcul
+    # dM: list of the number of predecessors for each node Sk: list
+    # of nodes with rank k, starting with nodes which have no
+    # predecessors. The ranks are computed iteratively (Kahn's
+    # algorithm) level by level. nodesrank: list of nodes ordered by
+    # priority in the calcul. It is cached until the model is modified
+    # (add_node, add_equation). Nodes that can't be ranked are in an
+    # algebraic loop (or depend on one), see loops()
     #########################################################################
 
     def set_rank(self):
+        if self.nodesrank is not None:
+            return
         d2, gM, gP = self.sub_graph_vertex(
             lambda x: type(x) == NodeDelay3 or type(x) == NodeFlow)
-        size = len(d2)
         dM = [len(gi) for gi in gM]
-        S0 = [i for i, di in enumerate(dM) if di == 0]
-        r = [None] * size
-
-        def rank_rec(Sk, k):
+        Sk = [i for i, di in enumerate(dM) if di == 0]
+        order = []
+        while Sk:
+            order += sorted(Sk)
             Sk1 = []
             for i in Sk:
-                r[i] = k
                 for j in gP[i]:
                     dM[j] -= 1
                     if dM[j] == 0:
                         Sk1.append(j)
-            if len(Sk1) > 0:
-                return rank_rec(Sk1, k+1)
-
-        rank_rec(S0, 0)
-        self.nodesrank = [
-            self.nodes[d2[j]] for _, j in sorted([(ri, i) for i, ri in enumerate(r)])]
+            Sk = Sk1
+        if len(order) < len(d2):
+            loops = self.loops()
+            unranked = len(d2) - len(order) - sum([len(l) for l in loops])
+            raise AlgebraicLoopError(
+                "Algebraic loops: " +
+                "; ".join([",".join(l) for l in loops]) +
+                f" ({unranked} nodes depend on them)")
+        self.nodesrank = [self.nodes[d2[j]] for j in order]
         self.nodesrank += self.stocks
 
+    # loops Returns the strongly connected components of flows and
+    # delays that forms a loop (algebraic loops) as lists of node
+    # names. Tarjan's algorithm, made iterative
+    def loops(self):
+        d2, gM, gP = self.sub_graph_vertex(
+            lambda x: type(x) == NodeDelay3 or type(x) == NodeFlow)
+        size = len(d2)
+        index = [None] * size
+        low = [0] * size
+        onstack = [False] * size
+        stack = []
+        sccs = []
+        counter = 0
+        for v0 in range(size):
+            if index[v0] is not None:
+                continue
+            work = [(v0, 0)]
+            while work:
+                v, pi = work.pop()
+                if pi == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append(v)
+                    onstack[v] = True
+                for i in range(pi, len(gP[v])):
+                    w = gP[v][i]
+                    if index[w] is None:
+                        work.append((v, i+1))
+                        work.append((w, 0))
+                        break
+                    if onstack[w]:
+                        low[v] = min(low[v], index[w])
+                else:
+                    if low[v] == index[v]:
+                        scc = []
+                        while True:
+                            w = stack.pop()
+                            onstack[w] = False
+                            scc.append(w)
+                            if w == v:
+                                break
+                        if len(scc) > 1 or v in gP[v]:
+                            sccs.append([d2[j] for j in reversed(scc)])
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+        return sccs
+
     # Plot node histories against time (x-axis)
     def plot_nodes(
             self, nodes, title=None, size=(10,5), formatter=None, show=True):
@@ -533,15 +1995,23 @@ class System:
     def reset(self):
         for _,n in self.nodes.items():
             n.reset()
-
-    # Set trace on nodes
-    def trace(self, *nodes):
+        self.steps = 0
+
+    # trace Records the values of nodes in every step in a Tracer,
+    # self.tracer (created when needed) unless another is given
+    def trace(self, *nodes, tracer=None):
+        if tracer is None:
+            if self.tracer is None:
+                self.tracer = Tracer()
+            tracer = self.tracer
         for n in nodes:
-            self.nodes[n].trace = True
+            self.nodes[n].trace = tracer
+        self.compiled = {}
     # Set history save on nodes
     def history(self, save, *nodes):
         for n in nodes:
             self.nodes[n].save = save
+        self.compiled = {}
 
     # dict Returns a reduced __dict__ used for serialization (json)
     def dict(self):
@@ -594,6 +2064,69 @@ class System:
                 case str(C):
                     node.val = n['val']
 
+    # set_params Sets constants and initial values of stocks from a
+    # dict {name: value}, or a dict as used by update()
+    def set_params(self, params):
+        if 'nodes' in params:
+            self.update(params)
+            return
+        for name, v in params.items():
+            node = self.nodes[name]
+            if type(node) == NodeStock:
+                node.val = node.hist[0] = v
+            else:
+                node.val = v
+
+#############################################################################
+# sweep Runs a model for many parameter sets in a pool of
+# processes. A System can't be pickled (equations are closures and
+# lambdas), so each worker builds its own model once with factory(),
+# which must be picklable (a module level function or a
+# functools.partial). For each parameter set the worker restores the
+# initial state, sets the parameters (see System.set_params()), runs
+# only the nodes needed for the "outputs" nodes (see System.prune()),
+# and sends back their histories, as arrays with None as NaN.
+#
+# param_grid is a list of parameter sets, or a dict {name: [values]}
+# for all combinations. (params, {name: array}) is yielded for each
+# parameter set, in order. With workers=1 everything is done in this
+# process
+#############################################################################
+
+def sweep(factory, param_grid, outputs, workers=None, end_time=None):
+    if type(param_grid) == dict:
+        names = list(param_grid)
+        points = [
+            dict(zip(names, v)) for v in itertools.product(*param_grid.values())]
+    else:
+        points = list(param_grid)
+    init = (factory, outputs, end_time)
+    if workers == 1:
+        sweep_init(*init)
+        for p in points:
+            yield p, sweep_run(p)
+        return
+    workers = workers if workers else os.cpu_count()
+    chunk = max(1, len(points) // (workers * 4))
+    with multiprocessing.Pool(workers, sweep_init, init) as pool:
+        yield from zip(points, pool.imap(sweep_run, points, chunk))
+
+# The model of a sweep worker, and what to do with it
+sweeper = None
+
+def sweep_init(factory, outputs, end_time):
+    global sweeper
+    s = factory()
+    s.set_rank()
+    sweeper = (s, s.snapshot(), outputs, end_time)
+
+def sweep_run(params):
+    s, snapshot, outputs, end_time = sweeper
+    s.restore(snapshot)
+    s.set_params(params)
+    s.run(end_time, outputs=outputs)
+    return {n: np.array(s.nodes[n].hist, dtype=float) for n in outputs}
+
 # Plot nodes from different system runs
 def plot_nodes(
         s1, s2, nodes=[], title=None, size=(10,5), formatter="eng"):
@@ -620,50 +2153,17 @@ def plot_nodes(
 # NRMSE isn't really SD, but is used to compare the model
 # with empirical data.
 # https://discovery.cs.illinois.edu/guides/Statistics-with-Python/rmse/
-import numpy as np
 def nrmse(empiric, model):
     actual = np.array(empiric)
     predicted = np.array(model)
     mse = ((predicted - actual) ** 2).mean()
     return np.sqrt(mse)/actual.mean()
 # If an interval, e.g (2000,2100), is given, then time *must* be the
-# 'time' stock!
+# 'time' stock! Values where the empirical data is None are excluded
+# (see metrics.py)
 def nrmse_nodes(empiric, model, time=None, interval=None):
-    actual = empiric.hist
-    predicted = model.hist
-    # The 2 arrays have the same length, but "predicted" may contain
-    # None values. If the interval is given (tuple), the first is
-    # included but not the last (as range())
-    if interval:
-        t = time.hist
-        #print(f'time ({t[0]}-{t[-1]})')
-        first, last = interval
-        start = 0
-        while t[start] < first:
-            start = start + 1
-        #print(f'first={first}, last={last}, start={start}')
-        if last > t[-1]:
-            stop = len(t) - 1
-        else:
-            stop = start
-            while t[stop] <= last:
-                stop = stop + 1
-        actual = actual[start:stop]
-        predicted = predicted[start:stop]
-    # Exclude None-values in the "actual" array
-    if actual[0] == None:
-        start = 0
-        while actual[start] == None:
-            start = start + 1
-        actual = actual[start:]
-        predicted = predicted[start:]
-    if actual[-1] == None:
-        stop = 1
-        while actual[stop] != None:
-            stop = stop + 1
-        actual = actual[:stop]
-        predicted = predicted[:stop]
-    return nrmse(actual, predicted)
+    t = time.hist if interval else None
+    return float(metrics.nrmse(empiric.hist, model.hist, t, interval)[0])
 # Convenient function for nrmse in systems
 def nrmse_snodes(s, empiric, model, interval=None):
     n1 = s.nodes[empiric]
@@ -681,28 +2181,268 @@ def f_diff(original, term):
 def f_clip(c1, c2, ts, t):
     if t <= ts : return c1
     else : return c2
+#############################################################################
+# Table is a compiled "TABLE OF CONSTANTS" (CT). It is still the
+# tuple of [x,y] rows it was created from (rows become tuples), but
+# the x and y values and the slope of each segment are computed
+# once. A lookup starts with the segment used last time, which is
+# nearly always right since the input (often time) changes slowly.
+# Otherwise the segment is computed directly if x is evenly spaced,
+# or found by bisection. The segment is the first one with
+# x <= x[i+1], which is what the linear scan in f_tab finds, so
+# the result is exactly the same. Tables where x is not strictly
+# increasing keep the linear scan.
+#############################################################################
+
+
+class Table(tuple):
+    def __new__(cls, rows):
+        return super().__new__(cls, (tuple(r) for r in rows))
+
+    def __init__(self, rows):
+        self.xs = [r[0] for r in self]
+        self.ys = [r[1] for r in self]
+        self.last = len(self) - 2
+        self.sorted = all(
+            self.xs[i] < self.xs[i+1] for i in range(self.last + 1))
+        self.slopes = []
+        for i in range(self.last + 1):
+            dx = self.xs[i+1] - self.xs[i]
+            dy = self.ys[i+1] - self.ys[i]
+            self.slopes.append(dy / dx if dx != 0 else None)
+        self.step = None
+        if self.sorted and self.last > 0:
+            step = (self.xs[-1] - self.xs[0]) / (self.last + 1)
+            if all(abs(x - (self.xs[0] + i*step)) <= 1e-9 * step
+                   for i, x in enumerate(self.xs)):
+                self.step = step
+        # The segment used last time, and its bounds
+        self.i, self.lo, self.hi = 0, math.inf, math.inf
+        self.arrays = None
+
+    # segment Returns the index of the segment for xs[0] <= x <= xs[-1]
+    def segment(self, x):
+        xs = self.xs
+        if self.lo < x <= self.hi:
+            return self.i
+        if self.step is not None:
+            i = min(max(int((x - xs[0]) / self.step), 0), self.last)
+            # The guess may be one off due to rounding
+            while i > 0 and x <= xs[i]:
+                i -= 1
+            while x > xs[i+1]:
+                i += 1
+        else:
+            i = min(max(bisect_left(xs, x) - 1, 0), self.last)
+        self.i, self.lo, self.hi = i, xs[i], xs[i+1]
+        return i
+
+    # interpolate Returns the value for xs[0] <= x <= xs[-1], or None
+    # for NaN (which fails all the bound checks before)
+    def interpolate(self, x):
+        if x != x:
+            return None
+        if not self.sorted:
+            return scan(self, x)
+        i = self.segment(x)
+        return self.ys[i] + self.slopes[i] * (x - self.xs[i])
+
+    # interp Returns the values for an array, as np.interp
+    def interp(self, x, left=None, right=None):
+        if self.arrays is None:
+            self.arrays = (np.array(self.xs), np.array(self.ys))
+        return np.interp(x, *self.arrays, left=left, right=right)
+
+    # __call__ Interpolates, but returns the first/last value outside
+    # the table. Used by f_tab
+    def __call__(self, x):
+        if type(x) == np.ndarray:
+            return self.interp(x)
+        if self.lo < x <= self.hi:  # same segment as last time
+            i = self.i
+            return self.ys[i] + self.slopes[i] * (x - self.xs[i])
+        if x < self.xs[0]:
+            return self.ys[0]
+        if x > self.xs[-1]:
+            return self.ys[-1]
+        return self.interpolate(x)
+
+    # clip Interpolates, but returns None outside the table. Used by
+    # f_tabclip
+    def clip(self, x):
+        if type(x) == np.ndarray:
+            return self.interp(x, left=np.nan, right=np.nan)
+        if x < self.xs[0] or x > self.xs[-1]:
+            return None   # out-of-bounds
+        return self.interpolate(x)
+
+# scan Interpolates with a linear scan of the table. Used for tables
+# that are not plain tuples of rows, or where x is not increasing.
+# Returns None if no segment holds x (e.g. NaN)
+def scan(tab, x):
+    i = 0
+    while i < len(tab) - 1:
+        if tab[i][0] <= x <= tab[i+1][0]:
+            coeff = (tab[i+1][1]-tab[i][1]) / (tab[i+1][0]-tab[i][0])
+            return tab[i][1] + coeff * (x-tab[i][0])
+        i += 1
+
 # Interpolate a value from a "TABLE OF CONSTANTS" (CT)
 def f_tab(tab, x):
+    if type(tab) == Table:
+        return tab(x)
+    if type(x) == np.ndarray:
+        return np.interp(x, [r[0] for r in tab], [r[1] for r in tab])
     if x < tab[0][0]:       # lower than first
         return tab[0][1]
     if x > tab[-1][0]:      # higher than last
         return tab[-1][1]
     else:
-        i = 0
-        while i < len(tab):
-            if tab[i][0] <= x <= tab[i+1][0]:
-                coeff = (tab[i+1][1]-tab[i][1]) / (tab[i+1][0]-tab[i][0])
-                return tab[i][1] + coeff * (x-tab[i][0])
-            i += 1
+        return scan(tab, x)
 # f_tabclip Return None for values out-of-bounds. Use for instance for
 # empirical data that ends in the current year
 def f_tabclip(tab, x):
+    if type(tab) == Table:
+        return tab.clip(x)
+    if type(x) == np.ndarray:
+        return np.interp(
+            x, [r[0] for r in tab], [r[1] for r in tab],
+            left=np.nan, right=np.nan)
     if x < tab[0][0] or x > tab[-1][0]:
         return None   # out-of-bounds
     else:
-        i = 0
-        while i < len(tab):
-            if tab[i][0] <= x <= tab[i+1][0]:
-                coeff = (tab[i+1][1]-tab[i][1]) / (tab[i+1][0]-tab[i][0])
-                return tab[i][1] + coeff * (x-tab[i][0])
-            i += 1
+        return scan(tab, x)
+# f_tab_div Interpolates x/z, where z often is a unit constant (1)
+def f_tab_div(tab, x, z):
+    return f_tab(tab, x / z)
+
+# Numpy versions of the common functions, used in batch runs
+vectorized = {
+    f_sum: lambda *l: sum(l),
+    f_mul: lambda *l: math.prod(l),
+    f_clip: lambda c1, c2, ts, t: np.where(t <= ts, c1, c2),
+}
+
+# Identities of the common functions {f: (i, value, g)}; f(...) where
+# argument i is the value is g(...) without that argument, and gives
+# exactly the same result. Used by the compile and vector engines to
+# skip e.g. the divisions by the World3 unit constants (OY, GDPU...)
+identities = {
+    f_tab_div: (2, 1, f_tab),
+}
+
+# identity Returns (g, pred) for a node where an identity applies to
+# its equation, else None. Only constants (C) that are not "varying"
+# (see StateVector) are used, so the value can't change during a run
+def identity(n, varying=()):
+    rule = identities.get(n.cons) if type(n.pred) == list else None
+    if rule is None:
+        return None
+    i, value, g = rule
+    p = n.pred[i]
+    if type(p) != NodeConstant or p.type != C or p.name in varying \
+       or p.val != value:
+        return None
+    return g, n.pred[:i] + n.pred[i+1:]
+
+#############################################################################
+# Expression is an equation written as a string, e.g.
+# "ic*(1-fcaor)*cuf/icor". Names are nodes, and the predecessors are
+# the nodes in the order they first appear (or as given). The
+# expression is parsed with the Python parser, but only numbers,
+# node names, arithmetic (+ - * / **) and the functions in "builtins"
+# are allowed. It is compiled into a scalar function and a numpy
+# function (for batch runs). An Expression is picklable, it is
+# compiled again when unpickled
+#############################################################################
+
+def f_min(*a):
+    return min(a)
+def f_max(*a):
+    return max(a)
+
+builtins = {
+    'tab': (f_tab, f_tab),
+    'tabclip': (f_tabclip, f_tabclip),
+    'clip': (f_clip, vectorized[f_clip]),
+    'min': (f_min, lambda *a: functools.reduce(np.minimum, a)),
+    'max': (f_max, lambda *a: functools.reduce(np.maximum, a)),
+    'log': (math.log, np.log),
+    'exp': (math.exp, np.exp),
+    'abs': (abs, np.abs),
+}
+
+class Expression:
+    def __init__(self, text, nodes, pred=None):
+        self.text = text
+        tree = ast.parse(text, mode='eval')
+        variables = []
+        functions = []
+        for n in ast.walk(tree):
+            if isinstance(n, ast.Call):
+                if not (isinstance(n.func, ast.Name) and
+                        n.func.id in builtins) or n.keywords:
+                    raise ValueError(
+                        f"Invalid function call in: {text}")
+                functions.append(n.func)
+            elif isinstance(n, ast.Name):
+                if n in functions:
+                    continue
+                if n.id not in nodes:
+                    raise ValueError(f"Unknown node {n.id} in: {text}")
+                variables.append(n)
+            elif isinstance(n, ast.Constant):
+                if type(n.value) not in (int, float):
+                    raise ValueError(f"Invalid constant in: {text}")
+            elif not isinstance(n, (
+                    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load,
+                    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow,
+                    ast.USub, ast.UAdd)):
+                raise ValueError(
+                    f"Invalid {type(n).__name__} in: {text}")
+        # In the order of the text (ast.walk() is breadth first)
+        names = []
+        for n in sorted(variables, key=lambda n: n.col_offset):
+            if n.id not in names:
+                names.append(n.id)
+        if pred is not None:
+            pred_names = [p.name for p in pred]
+            for name in names:
+                if name not in pred_names:
+                    raise ValueError(f"{name} is not a predecessor: {text}")
+            names = pred_names
+        self.args = names
+        self.compile()
+
+    # compile Creates the scalar and vector functions. Nodes are
+    # arguments a0, a1,.. and functions are called as _name
+    def compile(self):
+        tree = ast.parse(self.text, mode='eval')
+        args = {name: f'a{i}' for i, name in enumerate(self.args)}
+        class Rename(ast.NodeTransformer):
+            def visit_Call(self, n):
+                n.args = [self.visit(a) for a in n.args]
+                n.func = ast.Name(id='_' + n.func.id, ctx=ast.Load())
+                return n
+            def visit_Name(self, n):
+                return ast.Name(id=args[n.id], ctx=ast.Load())
+        body = ast.unparse(Rename().visit(tree))
+        src = f"lambda {', '.join(args.values())}: {body}"
+        code = compile(src, f"<Expression {self.text}>", "eval")
+        self.scalar = eval(
+            code, {'_' + k: f[0] for k, f in builtins.items()})
+        self.vector = eval(
+            code, {'_' + k: f[1] for k, f in builtins.items()})
+
+    def __call__(self, *a):
+        return self.scalar(*a)
+
+    def __repr__(self):
+        return f"Expression({self.text!r})"
+
+    def __getstate__(self):
+        return {'text': self.text, 'args': self.args}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
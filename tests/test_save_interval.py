@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: Unlicense
+"""
+save_interval only thins the histories. Per-step work (tracers, and
+nodes that evaluate themselves) is done every step in all engines.
+Run with "python -m pytest tests".
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import system_dynamic as sd
+import grass_sheep
+
+# run_hooked Runs grass+sheep with a tracer on graze, and the delay
+# wrapped so it is evaluated by NodeDelay3.eval(). Returns the system,
+# the tracer and the number of delay evaluations
+def run_hooked(engine, save_interval):
+    s = sd.System(time_step=0.01, end_time=10)
+    grass_sheep.load_model(s, delay=0.5)
+    s.save_interval = save_interval
+    dd = s.nodes['dd']
+    calls = [0]
+    def hook(flow, constant):
+        calls[0] += 1
+        dd.f_delayinit(flow, constant)
+    dd.cons = hook
+    t = sd.Tracer()
+    s.trace('graze', tracer=t)
+    s.run(engine=engine)
+    return s, t, calls[0]
+
+def test_hooks_every_step():
+    ref, tref, cref = run_hooked("interpret", 0.1)
+    for engine in ("compile", "vector"):
+        s, t, calls = run_hooked(engine, 0.1)
+        assert calls == cref == 1000
+        assert t.count == tref.count == 1000
+        assert list(t.records()['value']) == list(tref.records()['value'])
+        for name in ('graze', 'dd', 'sheep', 'time'):
+            assert len(s.nodes[name].hist) in (100, 101)
+            assert list(s.nodes[name].hist) == list(ref.nodes[name].hist)
@@ -0,0 +1,32 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Table lookups. Run with "python -m pytest tests".
+"""
+import sys
+import os
+import math
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import system_dynamic as sd
+
+rows = [[0, 1], [10, 3], [20, 2], [30, 6]]   # evenly spaced
+uneven = [[0, 1], [5, 3], [20, 2], [21, 6]]  # bisection
+unsorted = [[0, 1], [10, 3], [10, 2], [30, 6]]  # linear scan
+
+# The Table gives the same values as the linear scan in f_tab
+def test_same_as_scan():
+    for r in (rows, uneven, unsorted):
+        t = sd.Table(r)
+        for x in [-1, 0, 0.5, 5, 10, 10.5, 19.9, 20, 21, 29, 30, 31, 3, 0]:
+            assert t(x) == sd.f_tab(r, x)
+            assert t.clip(x) == sd.f_tabclip(r, x)
+
+# NaN is outside every segment, and gives None as out-of-bounds does
+def test_nan():
+    for r in (rows, uneven, unsorted):
+        t = sd.Table(r)
+        t(15)
+        for f in (t, t.clip, lambda x: sd.f_tab(r, x),
+                  lambda x: sd.f_tabclip(r, x)):
+            assert f(math.nan) is None
+        # The last segment is still used after a NaN
+        assert t(15) == sd.f_tab(r, 15)
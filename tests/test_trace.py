@@ -0,0 +1,57 @@
+# SPDX-License-Identifier: Unlicense
+"""
+Tracers give the same records in all engines. Run with "python -m
+pytest tests".
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import system_dynamic as sd
+import grass_sheep
+
+engines = ("interpret", "compile", "vector")
+traced = ("sheep", "graze", "starvation", "dd")
+
+# run_traced Returns {(step, node name): value} of a traced run
+def run_traced(
+        engine, delay=0.5, save_interval=None, nosave=(), iterate=False):
+    s = sd.System(time_step=0.01, end_time=10)
+    grass_sheep.load_model(s, delay=delay)
+    s.save_interval = save_interval
+    s.history(False, *nosave)
+    t = sd.Tracer(size=1 << 18)
+    s.trace(*traced, tracer=t)
+    if iterate:
+        s.engine = engine
+        for r in s.iter_run(["sheep"], chunk=100, history=False):
+            pass
+    else:
+        s.run(engine=engine)
+    r = t.records()
+    return {(int(step), t.names[k]): v
+            for step, k, v in zip(r['step'], r['node'], r['value'])}
+
+def check(**kw):
+    records = [run_traced(engine, **kw) for engine in engines]
+    assert len(records[0]) == 4 * 1000
+    for r in records[1:]:
+        assert r == records[0]
+
+def test_every_step():
+    check()
+
+def test_save_interval():
+    check(save_interval=1)
+
+def test_not_saved():
+    check(nosave=traced)
+
+def test_iter_run():
+    check(iterate=True)
+
+# A zero-delay is not recorded, as it has no history
+def test_zero_delay():
+    records = [run_traced(engine, delay=0) for engine in engines]
+    assert len(records[0]) == 3 * 1000
+    for r in records[1:]:
+        assert r == records[0]
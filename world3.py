@@ -24,6 +24,7 @@ calibration.
 import sys
 import os
 import argparse
+import functools
 import json
 import numpy
 import matplotlib.pyplot as plt
@@ -32,6 +33,11 @@ import world3_model as world3
 import le
 import world3_modifications as w3mod
 import empirical_data as emp
+import montecarlo
+import sensitivity
+import calibrate
+import cache
+import metrics
 
 dbg = lambda *arg: 0
 stitle=[
@@ -54,7 +60,7 @@ sow_nodes=[
 
 # Translate constant name PyWorld3-03 -> world3.
 # Used to set recalibration constants for world3 runs
-def constant_name(s, n):
+def constant_name(s, n, version=None):
     nmap = {
         "icor2": "", # This is a flow in 2003 update
         "pp19": "PPOLI", # Same value
@@ -76,14 +82,14 @@ def constant_name(s, n):
     nn = n.upper()
     if nn in s.nodes:
         return nn
-    if conf.version == 1972:
+    if (version or conf.version) == 1972:
         print(f"Ignored in the 1972 version: {n}")
         return ""
     raise ValueError(f"Unknown node name: {n}")
 
 # Read the recelibration constants from PyWorld3-03
-def recal23_constants():
-    with open("constants.json", 'r') as file:
+def recal23_constants(file_name=None):
+    with open(file_name or conf.recal23_file, 'r') as file:
         data = json.load(file)
     #for key in iter(data['constants']):
     #    dbg(key, data['constants'][key]['value'])
@@ -123,17 +129,18 @@ def pyworld3_run(recal23=False):
     s.nodes["ppolx"].hist = pyworld3.ppolx[:-1]
     return s
 
-def recal23(s):
-    data = recal23_constants()
+def recal23(s, settings=None):
+    settings = settings or conf
+    data = recal23_constants(settings.recal23_file)
     for c in iter(data['constants']):
-        n = constant_name(s, c)
+        n = constant_name(s, c, settings.version)
         if not n:
             continue
         s.nodes[n].val = data['constants'][c]['value']
     world3.reinit_stocks(s)
     s.reset()
 
-def modify_world3(s, mod):
+def modify_world3(s, mod, settings=None):
     match mod:
         case "read_m":
             le.modify_M(s)
@@ -144,7 +151,7 @@ def modify_world3(s, mod):
         case "remove_uconst":
             w3mod.remove_unit_constants(s)
         case "recal23":
-            recal23(s)
+            recal23(s, settings)
         case _:
             print("Modification ignored: ", mod)
 
@@ -157,14 +164,58 @@ def modify_help():
     recal23 - Recalibration23
 ''')
 
-def load_world3(modify=True):
-    s = sd.System(init_time=1900, end_time=2100, time_step=conf.ts)
-    world3.load(s, scenario=conf.scenario, version=conf.version)
-    if modify and conf.mods:
-        for m in conf.mods.split(','):
-            modify_world3(s, m)
+# Loaded models are kept as prototypes, and clones are returned
+prototypes = {}
+
+# factory_settings Returns a copy of the options load_world3() uses.
+# The global conf is only set by parse_args(), so factories for worker
+# processes (spawn) get them passed, e.g.
+# functools.partial(load_world3, settings=factory_settings())
+def factory_settings():
+    return argparse.Namespace(**{
+        k: getattr(conf, k) for k in (
+            'ts', 'scenario', 'version', 'mods', 'engine', 'method',
+            'recal23_file')})
+
+def load_world3(modify=True, settings=None):
+    c = settings or conf
+    key = (c.ts, c.scenario, c.version, modify and c.mods, c.recal23_file)
+    if key not in prototypes:
+        s = sd.System(init_time=1900, end_time=2100, time_step=c.ts)
+        world3.load(s, scenario=c.scenario, version=c.version)
+        if modify and c.mods:
+            for m in c.mods.split(','):
+                modify_world3(s, m, c)
+        s.set_rank()
+        prototypes[key] = s
+    s = prototypes[key].clone()
+    s.engine = c.engine
+    s.method = c.method
     return s
 
+# constant_ranges Returns {names: (low, high)} for constants (names
+# as in constants.json, or "all") with +-spread around their value.
+# Stocks initiated by a constant are included in its names
+def constant_ranges(s, constants, spread):
+    if constants == "all":
+        constants = list(recal23_constants()['constants'])
+    else:
+        constants = constants.split(',')
+    ranges = {}
+    for c in constants:
+        n = constant_name(s, c)
+        if not n or type(s.nodes[n]) != sd.NodeConstant:
+            continue
+        v = s.nodes[n].val
+        names = tuple([n] + initiated_stocks(s, n))
+        ranges[names] = (v * (1 - spread), v * (1 + spread))
+    return ranges
+
+# initiated_stocks Returns the names of stocks with a constant as
+# initial value (by name, e.g. NRI for nr)
+def initiated_stocks(s, constant):
+    return [n.name for n in s.stocks if n.name.upper() + "I" == constant]
+
 def print23_constants():
     data = recal23_constants()
     load_world3()
@@ -245,7 +296,7 @@ def cmd_pyworld3(args):
     s2 = load_world3()
     if args.recal23:
         recal23(s2)
-    s2.run()
+    cache.run(s2, bypass=conf.no_cache)
     sd.plot_nodes(s1, s2, nodes=sow_nodes, title=stitle[conf.scenario-1])
 
 def cmd_run(args):
@@ -259,14 +310,14 @@ def cmd_run(args):
         '--welfare', action='store_true', help="Show welfare plots")
     args = parser.parse_args(args[1:])
     s = load_world3()
-    s.run()
+    cache.run(s, bypass=conf.no_cache)
     wf_nodes=[
         ("fpc",(0, 1e3)),("le",(0, 90)),("sopc",(0, 1e3)),("ciopc",(0, 250))]
     ef_nodes=[("hwi",(0, 1)),("hef",(0, 4))]
     if conf.mods:
         # Compare with an unmodified model
         s2 = load_world3(modify=False)
-        s2.run()
+        cache.run(s2, bypass=conf.no_cache)
         sd.plot_nodes(s, s2, nodes=sow_nodes, title=stitle[conf.scenario-1])
         if args.welfare:
             sd.plot_nodes(s, s2, nodes=wf_nodes, title=stitle[conf.scenario-1])
@@ -283,10 +334,10 @@ def cmd_bau2(args):
     args = parser.parse_args(args[1:])
     conf.scenario = 2
     s = load_world3()
-    s.run()
+    cache.run(s, bypass=conf.no_cache)
     conf.scenario = 1
     s2 = load_world3()
-    s2.run()
+    cache.run(s2, bypass=conf.no_cache)
     sd.plot_nodes(s, s2, nodes=sow_nodes, title="BAU2 (BAU dashed)")
 
 def cmd_mods(args):
@@ -308,7 +359,7 @@ def cmd_animate(args):
         NRI.val = r
         nr.hist[0] = r
         s.reset()
-        s.run()
+        cache.run(s, bypass=conf.no_cache)
         s.plot(*sow_nodes, title="State Of The World", show=False,
                formatter="eng")
         if args.save:
@@ -343,22 +394,15 @@ def cmd_demography(args):
     s = load_world3()
     emp.load_wpop(s)
     emp.load_wle(s)
-    s.run()
+    cache.run(s, bypass=conf.no_cache)
     s2 = load_world3(modify=False)
     emp.load_wpop(s2)
     emp.load_wle(s2)
-    s2.run()
-    t = s.nodes["time"]
+    cache.run(s2, bypass=conf.no_cache)
     interval=(2000,2025)
-    print(f"Normalized Root Mean Square Error (or Difference): {interval}")
-    nrmse = sd.nrmse_snodes(s2, 'wpop', 'pop', interval=interval)
-    print(f"NRMSE(pop) = {nrmse*100:.2f}% (unmodified)")
-    nrmse = sd.nrmse_snodes(s, 'wpop', 'pop', interval=interval)
-    print(f"NRMSE(pop) = {nrmse*100:.2f}%")
-    nrmse = sd.nrmse_snodes(s2, 'wle', 'le', interval=interval)
-    print(f"NRMSE(le) = {nrmse*100:.2f}% (unmodified)")
-    nrmse = sd.nrmse_snodes(s, 'wle', 'le', interval=interval)
-    print(f"NRMSE(le) = {nrmse*100:.2f}%")
+    print(f"Goodness of fit: {interval}")
+    r = metrics.compare([s2, s], [('wpop', 'pop'), ('wle', 'le')], interval)
+    metrics.report(r, labels=["unmodified", "modified"])
     nodes=[("pop",(0,10e9)), ("wpop",(0,10e9)), ("le",(0,90)), ("wle",(0,90))]
     sd.plot_nodes(s, s2, nodes=nodes, title=stitle[conf.scenario-1], size=(8,4))
 
@@ -370,20 +414,14 @@ def cmd_rates(args):
     s = load_world3()
     emp.load_wcbr(s)
     emp.load_wcdr(s)
-    s.run()
+    cache.run(s, bypass=conf.no_cache)
     s2 = load_world3(modify=False)
     emp.load_wcbr(s2)
     emp.load_wcdr(s2)
-    s2.run()
-    print(f"Normalized Root Mean Square Error (or Difference)")
-    nrmse = sd.nrmse_snodes(s2, 'wcbr', 'cbr')
-    print(f"NRMSE(cbr) = {nrmse*100:.2f}% (unmodified)")
-    nrmse = sd.nrmse_snodes(s, 'wcbr', 'cbr')
-    print(f"NRMSE(cbr) = {nrmse*100:.2f}%")
-    nrmse = sd.nrmse_snodes(s2, 'wcdr', 'cdr')
-    print(f"NRMSE(cdr) = {nrmse*100:.2f}% (unmodified)")
-    nrmse = sd.nrmse_snodes(s, 'wcdr', 'cdr')
-    print(f"NRMSE(cdr) = {nrmse*100:.2f}%")
+    cache.run(s2, bypass=conf.no_cache)
+    print("Goodness of fit")
+    r = metrics.compare([s2, s], [('wcbr', 'cbr'), ('wcdr', 'cdr')])
+    metrics.report(r, labels=["unmodified", "modified"])
     nodes=[("cbr",(0,50)), ("cdr", (0,50)), ("wcbr",(0,50)), ("wcdr",(0,50))]
     sd.plot_nodes(s, s2, nodes=nodes, title=stitle[conf.scenario-1])
 
@@ -398,16 +436,222 @@ def cmd_hef(args):
     s = load_world3()
     emp.load_whef(s)
     w3mod.recalibrate_hef(s)
-    s.run()
+    cache.run(s, bypass=conf.no_cache)
     s2 = load_world3(modify=False)
     emp.load_whef(s2)
     w3mod.recalibrate_hef(s2)
-    s2.run()
+    cache.run(s2, bypass=conf.no_cache)
     nodes=[
         ("hef",(0,25e9)), ("algha",(0,25e9)), ("whef",(0,25e9)),
         ("walg",(0,25e9))]
     sd.plot_nodes(s, s2, nodes=nodes, title=stitle[conf.scenario-1])
 
+def cmd_scenarios(args):
+    """Run scenarios 2-9 and print the state of the world at the end.
+
+    The scenarios are the same up to the policy year (2002). That part
+    is simulated once, and each scenario continues from a snapshot.
+    """
+    parser = argparse.ArgumentParser(
+        prog="scenarios", description=cmd_scenarios.__doc__)
+    parser.add_argument(
+        '--year', type=float, default=2002, help="Fork year")
+    args = parser.parse_args(args[1:])
+    conf.scenario = 2
+    s = load_world3()
+    s.run(until=args.year)
+    snapshot = s.snapshot()
+    nodes = [n for n,_ in sow_nodes]
+    print(f"{'Scenario':<28}" + "".join([f"{n:>10}" for n in nodes]))
+    for scenario in range(2, 10):
+        conf.scenario = scenario
+        constants = [
+            n.dict() for n in load_world3().nodes.values()
+            if type(n) == sd.NodeConstant]
+        s.restore(snapshot)
+        s.update({'nodes': constants})
+        s.run()
+        values = [s.nodes[n].hist[-1] for n in nodes]
+        print(f"{scenario:>2} {stitle[scenario-1]:<25}" +
+              "".join([f"{v:>10.3g}" for v in values]))
+
+def cmd_sweep(args):
+    """Sweep a constant and print the state of the world at the end.
+
+    The runs are made in parallel, with one model per worker process.
+    If the constant is the initial value of a stock (e.g. NRI for nr)
+    the stock is set too.
+    """
+    parser = argparse.ArgumentParser(
+        prog="sweep", description=cmd_sweep.__doc__)
+    parser.add_argument(
+        '--constant', default="NRI", help="Constant to sweep")
+    parser.add_argument(
+        '--values', default="1e12,2e12,11", help="first,last,count")
+    parser.add_argument(
+        '--workers', type=int, default=None, help="Worker processes")
+    args = parser.parse_args(args[1:])
+    first, last, count = [float(x) for x in args.values.split(',')]
+    s = load_world3()
+    names = [args.constant] + initiated_stocks(s, args.constant)
+    grid = [
+        {n: v for n in names}
+        for v in numpy.linspace(first, last, int(count))]
+    nodes = [n for n,_ in sow_nodes]
+    print(f"{args.constant:<12}" + "".join([f"{n:>10}" for n in nodes]))
+    factory = functools.partial(load_world3, settings=factory_settings())
+    for p, h in sd.sweep(factory, grid, nodes, workers=args.workers):
+        print(f"{p[args.constant]:<12.4g}" +
+              "".join([f"{h[n][-1]:>10.3g}" for n in nodes]))
+
+def cmd_montecarlo(args):
+    """Monte Carlo runs with uncertain constants, shown as fan charts.
+
+    The constants get a uniform distribution of +-spread around their
+    value in the model. Names are as in constants.json. The bands are
+    the 5-95% and 25-75% ranges and the line is the median. The runs
+    are made in batches, which only support --method euler.
+    """
+    parser = argparse.ArgumentParser(
+        prog="montecarlo", description=cmd_montecarlo.__doc__)
+    parser.add_argument(
+        '--constants', default="dcfsn,hsid,len,mtfn,lfpf,icor1,lyf1,nri",
+        help="Constants, or 'all' for all in constants.json")
+    parser.add_argument(
+        '--spread', type=float, default=0.1, help="Relative spread")
+    parser.add_argument('--runs', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(args[1:])
+    s = load_world3()
+    distributions = {
+        names: montecarlo.uniform(*r)
+        for names, r in constant_ranges(s, args.constants, args.spread).items()}
+    r = montecarlo.run(
+        s, distributions, args.runs, [n for n,_ in sow_nodes], seed=args.seed)
+    r.plot(*sow_nodes, title=f"{stitle[conf.scenario-1]} ({r.runs} runs)")
+
+def cmd_sensitivity(args):
+    """Sensitivity of the state of the world to constants.
+
+    Morris screening (default) or Sobol indices. The constants vary
+    +-spread around their value in the model. Names are as in
+    constants.json. Windows are "from-to,..." years, the effect is on
+    the mean value in each window. The runs are made in batches, which
+    only support --method euler.
+    """
+    parser = argparse.ArgumentParser(
+        prog="sensitivity", description=cmd_sensitivity.__doc__)
+    parser.add_argument(
+        '--method', default="morris", choices=["morris", "sobol"])
+    parser.add_argument(
+        '--constants', default="dcfsn,hsid,len,mtfn,lfpf,icor1,lyf1,nri",
+        help="Constants, or 'all' for all in constants.json")
+    parser.add_argument(
+        '--spread', type=float, default=0.1, help="Relative spread")
+    parser.add_argument(
+        '--windows', default="2000-2025,2075-2100", help="Time windows")
+    parser.add_argument(
+        '--n', type=int, default=None,
+        help="Trajectories (morris, default 20) or samples (sobol, default 1000)")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(args[1:])
+    s = load_world3()
+    ranges = constant_ranges(s, args.constants, args.spread)
+    windows = [
+        tuple([float(y) for y in w.split('-')])
+        for w in args.windows.split(',')]
+    outputs = [n for n,_ in sow_nodes]
+    if args.method == "morris":
+        r = sensitivity.morris(
+            s, ranges, outputs, r=args.n or 20, windows=windows, seed=args.seed)
+    else:
+        r = sensitivity.sobol(
+            s, ranges, outputs, n=args.n or 1000, windows=windows,
+            seed=args.seed)
+    sensitivity.report(r)
+
+# Factory for calibration workers. The empirical data must be in the
+# model to get the targets
+def load_world3_empirical(settings=None):
+    s = load_world3(settings=settings)
+    for load in (emp.load_wpop, emp.load_wle, emp.load_wcbr,
+                 emp.load_wcdr, emp.load_whef):
+        load(s)
+    return s
+
+def cmd_calibrate(args):
+    """Fit constants to empirical data.
+
+    The constants (names as in constants.json) are varied +-spread
+    around their value in the model, to minimise the mean NRMSE of the
+    model nodes compared with empirical data. The result is written in
+    the same format as constants.json, and can be used with
+    "--recal23-file FILE -m recal23".
+    """
+    parser = argparse.ArgumentParser(
+        prog="calibrate", description=cmd_calibrate.__doc__)
+    parser.add_argument(
+        '--constants', default="dcfsn,hsid,len,mtfn",
+        help="Constants, or 'all' for all in constants.json")
+    parser.add_argument(
+        '--spread', type=float, default=0.2, help="Relative spread")
+    parser.add_argument(
+        '--pairs', default="wpop:pop,wle:le,wcbr:cbr,wcdr:cdr",
+        help="empirical:model,... (e.g. whef:hef)")
+    parser.add_argument(
+        '--interval', default="1950,2025", help="first,last year")
+    parser.add_argument('--generations', type=int, default=20)
+    parser.add_argument('--population', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument(
+        '--output', default="calibrated.json", help="Output file")
+    args = parser.parse_args(args[1:])
+    s = load_world3()
+    ranges = constant_ranges(s, args.constants, args.spread)
+    pairs = [tuple(p.split(':')) for p in args.pairs.split(',')]
+    interval = tuple([float(y) for y in args.interval.split(',')])
+    r = calibrate.run(
+        functools.partial(load_world3_empirical, settings=factory_settings()),
+        ranges, pairs, interval=interval,
+        population=args.population, generations=args.generations,
+        workers=args.workers, seed=args.seed, verbose=True)
+    print(f"NRMSE {r['nrmse']*100:.3f}% ({r['runs']} runs, "
+          f"{r['aborted']} aborted)")
+    # Write in the format of constants.json, with the names used there
+    known = recal23_constants()['constants']
+    constants = {}
+    names = args.constants.split(',') if args.constants != "all" \
+        else list(known)
+    for c in names:
+        n = constant_name(s, c)
+        if n not in r['params']:
+            continue
+        txt = known[c]['txt'] if c in known else s.nodes[n].detail
+        constants[c] = {'value': r['params'][n], 'txt': txt}
+        print(f"  {c:<10} {s.nodes[n].val:<12.6g} -> {r['params'][n]:.6g}")
+    with open(args.output, 'w') as f:
+        json.dump({'constants': constants}, f, indent='\t')
+
+def cmd_profile(args):
+    """Profile a run; time per node and category.
+
+    The nodes are evaluated one by one regardless of --engine.
+    """
+    parser = argparse.ArgumentParser(
+        prog="profile", description=cmd_profile.__doc__)
+    parser.add_argument(
+        '--top', type=int, default=20, help="Number of nodes to print")
+    parser.add_argument('--json', help="Write the profile to this file")
+    args = parser.parse_args(args[1:])
+    s = load_world3()
+    p = sd.Profile()
+    s.run(profile=p)
+    p.report(top=args.top)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(p.dict(), f, indent='\t')
+
 def cmd_categories(args):
     """Show categories"""
     s = load_world3()
@@ -429,7 +673,19 @@ def parse_args():
     parser.add_argument(
         '--version', type=int, default=2003, help="Version. 1972 or 2003")
     parser.add_argument('--ts', type=float, default=1.0, help="time-step")
-    parser.add_argument('-m', '--mods', default="")    
+    parser.add_argument(
+        '--engine', default="compile", choices=["interpret", "compile"],
+        help="Evaluation engine")
+    parser.add_argument(
+        '--method', default="euler", choices=["euler", "rk4", "rk45"],
+        help="Integration method")
+    parser.add_argument('-m', '--mods', default="")
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help="Don't use the cache of runs (see cache.py)")
+    parser.add_argument(
+        '--recal23-file', default="constants.json",
+        help="Constants for the recal23 mod")    
     parser.add_argument('cmd', choices=cmds, nargs=argparse.REMAINDER)
     global conf
     conf = parser.parse_args()
@@ -1364,20 +1364,9 @@ def load(world3, scenario=1, version=2003):
         else : return c2
 
     # Interpolate a value from a "TABLE OF CONSTANTS" (CT)
-    def f_tab(tab, x):
-        if x < tab[0][0]:       # lower than first
-            return tab[0][1]
-        if x > tab[-1][0]:      # higher than last
-            return tab[-1][1]
-        else:
-            i = 0
-            while i < len(tab):
-                if tab[i][0] <= x <= tab[i+1][0]:
-                    coeff = (tab[i+1][1]-tab[i][1]) / (tab[i+1][0]-tab[i][0])
-                    return tab[i][1] + coeff * (x-tab[i][0])
-                i += 1
-
-    def f_tab_div(x, y, z): return f_tab(x, y/z)
+    f_tab = sd.f_tab
+
+    f_tab_div = sd.f_tab_div
 
     def f_tab_dif(x, y, z): return f_tab(x, y - z)
 